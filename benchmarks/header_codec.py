@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Network Tester header codec micro-benchmark
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Compares the time taken to write and read packet headers byte by byte, as the tester used to, with the
+# packetheader codec. Run with: python3 benchmarks/header_codec.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import packetheader
+
+packet_size = 18
+batch_size = 64
+slot_size = 4096
+repeat = 5
+
+packet = bytearray(packet_size)
+packetheader.pack_header(packet, packet_size, 1)
+
+pool = bytearray(batch_size * slot_size)
+for x in range(batch_size):
+    packetheader.pack_header(memoryview(pool)[x * slot_size:], packet_size, x + 1)
+
+def legacy_pack_sequence(sequence_number):
+    packet[8] = (sequence_number >> 24) & 0xFF
+    packet[9] = (sequence_number >> 16) & 0xFF
+    packet[10] = (sequence_number >> 8) & 0xFF
+    packet[11] = (sequence_number >> 0) & 0xFF
+
+def legacy_unpack_header(readdata):
+    data = bytearray(readdata)
+    magic = (data[0] << 24) | (data[1] << 16) | (data[2] << 8) | data[3]
+    pktlen = (data[4] << 24) | (data[5] << 16) | (data[6] << 8) | data[7]
+    seq = (data[8] << 24) | (data[9] << 16) | (data[10] << 8) | data[11]
+    return magic, pktlen, seq
+
+def legacy_unpack_batch():
+    for x in range(batch_size):
+        legacy_unpack_header(pool[x * slot_size:x * slot_size + packet_size])
+
+def codec_unpack_batch():
+    for x in range(batch_size):
+        packetheader.unpack_header(pool, x * slot_size)
+
+def codec_unpack_headers():
+    packetheader.unpack_headers(pool, slot_size, batch_size)
+
+# Report the best time per packet, in nanoseconds
+def run(name, statement, packets_per_call, number):
+    best = min(timeit.repeat(statement, number=number, repeat=repeat))
+    print('{:<40}{:>10.1f} ns/packet'.format(name, best * 1e9 / number / packets_per_call))
+
+print('NumPy {}'.format(packetheader.numpy.__version__ if packetheader.numpy else 'not available'))
+run('byte by byte sequence number', lambda: legacy_pack_sequence(12345), 1, 200000)
+run('pack_sequence', lambda: packetheader.pack_sequence(packet, 12345), 1, 200000)
+run('byte by byte header parse', lambda: legacy_unpack_header(packet), 1, 200000)
+run('unpack_header', lambda: packetheader.unpack_header(packet), 1, 200000)
+run('byte by byte header parse, batch', legacy_unpack_batch, batch_size, 2000)
+run('unpack_header, batch', codec_unpack_batch, batch_size, 2000)
+run('unpack_headers, batch', codec_unpack_headers, batch_size, 2000)
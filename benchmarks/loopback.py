@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+# Network Tester loopback benchmark
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Runs a sender and a listener over loopback for each payload size and protocol, to find the packet rate the tester
+# itself can sustain. For UDP, the sender searches for the highest rate with --find-max, and the rate actually sent
+# in the best trial that kept its loss within --max-loss is taken. For TCP, the sender sends as fast as it can and the
+# rate is what the listener received. The CPU time used by the sender and listener processes is divided by the
+# number of packets to give a cost per packet. Results are printed, and saved as JSON so that runs before and after
+# a change can be compared:
+#
+#   python3 benchmarks/loopback.py --output before.json
+#   python3 benchmarks/loopback.py --output after.json --compare before.json
+
+import datetime
+import getopt
+import json
+import os
+import platform
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+tester = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'networktester.py')
+
+sizes = [12, 64, 128, 256, 512, 1024, 1472]
+protocols = ['udp', 'tcp']
+port = 20100
+period = 2.0
+max_pps = 1000000 # Highest packet rate tried by the UDP search
+max_loss = 0.1
+tcp_periods = 3 # Number of listener periods averaged for TCP
+startup_time = 1.0 # Time for the listener to start before the sender
+extra_args = []
+output = None
+compare = None
+
+ip4_overhead = 20
+eth_overhead = 18
+proto_overheads = {'udp': 8, 'tcp': 20}
+
+def usage():
+    print('loopback.py')
+    print('  --sizes <payload sizes separated by :, default {}>'.format(':'.join(map(str, sizes))))
+    print('  --protocols <udp, tcp or udp:tcp>')
+    print('  --port <port, default {}>'.format(port))
+    print('  --period <seconds per trial, default {}>'.format(period))
+    print('  --max-pps <highest packet rate tried for UDP, default {}>'.format(max_pps))
+    print('  --max-loss <percent of packets that may be lost, default {}>'.format(max_loss))
+    print('  --args <extra options for the sender, eg "--burst">')
+    print('  --output <JSON file for the results>')
+    print('  --compare <JSON file from an earlier run>')
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["help", "sizes=", "protocols=", "port=", "period=", "max-pps=", "max-loss=", "args=", "output=", "compare="])
+except getopt.GetoptError:
+    usage()
+    sys.exit(1)
+
+for opt, arg in opts:
+    if opt == '--help':
+        usage()
+        sys.exit(0)
+    elif opt == "--sizes":
+        sizes = list(map(int, arg.split(":")))
+    elif opt == "--protocols":
+        protocols = arg.split(":")
+    elif opt == "--port":
+        port = int(arg)
+    elif opt == "--period":
+        period = float(arg)
+    elif opt == "--max-pps":
+        max_pps = float(arg)
+    elif opt == "--max-loss":
+        max_loss = float(arg)
+    elif opt == "--args":
+        extra_args = arg.split()
+    elif opt == "--output":
+        output = arg
+    elif opt == "--compare":
+        compare = arg
+
+if [p for p in protocols if p not in proto_overheads]:
+    print('protocols must be udp and/or tcp')
+    usage()
+    sys.exit(1)
+
+# Size of a packet at the ethernet layer, in bits, as the tester counts it
+def packet_bits(protocol, size):
+    return (size + proto_overheads[protocol] + ip4_overhead + eth_overhead) * 8
+
+# Start the tester with its output going to a temporary file. Returns (process, output file).
+def start(options):
+    out = tempfile.TemporaryFile(mode='w+')
+    process = subprocess.Popen([sys.executable, tester, '--port', str(port)] + options, stdout=out, stderr=subprocess.STDOUT, universal_newlines=True)
+    return process, out
+
+# Wait for the tester to exit, interrupting it first if stop is set. Returns (output, CPU seconds used).
+def finish(process, out, stop=False):
+    if stop:
+        os.kill(process.pid, signal.SIGINT)
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    out.seek(0)
+    text = out.read()
+    out.close()
+    return text, usage.ru_utime + usage.ru_stime
+
+# Start the listener and give it time to bind. Returns (None, None) if it fails, for example if the port is in use.
+def start_listener(options):
+    listener, out = start(['--listen'] + options)
+    time.sleep(startup_time)
+    if listener.poll() != None:
+        out.seek(0)
+        print(out.read())
+        out.close()
+        return None, None
+    return listener, out
+
+def run_udp(size):
+    listener, listener_out = start_listener(['--period', '3600'])
+    if not listener:
+        return None
+    sender, sender_out = start(['--address', '127.0.0.1', '--size', str(size), '--rate', str(max_pps * packet_bits('udp', size)),
+        '--find-max', '--max-loss', str(max_loss), '--period', str(period)] + extra_args)
+    sender_text, sender_cpu = finish(sender, sender_out)
+    listener_text, listener_cpu = finish(listener, listener_out, True)
+
+    sent = 0
+    received = 0
+    best = None
+    for line in sender_text.splitlines():
+        m = re.match(r'Trial at (\d+) bps: sent (\d+) packets, lost (\d+) .*, (pass|fail)', line)
+        if m:
+            trial_sent = int(m.group(2))
+            sent += trial_sent
+            received += trial_sent - int(m.group(3))
+            # The rate actually sent, which is less than requested if the sender can't keep up
+            pps = trial_sent / period
+            if (m.group(4) == 'pass') and ((best == None) or (pps > best)):
+                best = pps
+    if best == None:
+        print(sender_text)
+        return None
+    return best, sender_cpu / max(sent, 1), listener_cpu / max(received, 1)
+
+def run_tcp(size):
+    listener, listener_out = start_listener(['--tcp', '--period', str(period)])
+    if not listener:
+        return None
+    sender, sender_out = start(['--address', '127.0.0.1', '--tcp', '--size', str(size), '--rate', '0'] + extra_args)
+    # The first period is partial, so wait for one more than are used
+    time.sleep(period * (tcp_periods + 1) + period / 2)
+    sender_text, sender_cpu = finish(sender, sender_out, True)
+    listener_text, listener_cpu = finish(listener, listener_out, True)
+
+    rates = []
+    for line in listener_text.splitlines():
+        m = re.match(r'(\d+)\s+\d+\s+\d+\s+\d+\s+\d+\s*$', line)
+        if m:
+            rates.append(int(m.group(1)))
+    rates = rates[1:tcp_periods + 1]
+    if not rates:
+        print(listener_text)
+        return None
+    pps = sum(rates) / len(rates) / packet_bits('tcp', size)
+    packets = pps * period * (len(rates) + 1)
+    return pps, sender_cpu / packets, listener_cpu / packets
+
+def version():
+    with open(tester) as f:
+        m = re.search(r'sw_version_number = "(.*)"', f.read())
+    return m.group(1) if m else None
+
+results = []
+print('{:<6}{:>6}{:>12}{:>14}{:>16}{:>16}'.format('Proto', 'Size', 'Max pps', 'Max bps', 'Sender us/pkt', 'Listener us/pkt'))
+for protocol in protocols:
+    for size in sizes:
+        if protocol == 'udp':
+            r = run_udp(size)
+        else:
+            r = run_tcp(size)
+        if r == None:
+            print('{:<6}{:>6}  failed'.format(protocol, size))
+            continue
+        pps, sender_cpu, listener_cpu = r
+        results.append({'protocol': protocol, 'size': size, 'pps': pps, 'bps': pps * packet_bits(protocol, size),
+                        'sender_cpu_per_packet': sender_cpu, 'listener_cpu_per_packet': listener_cpu})
+        print('{:<6}{:>6}{:>12.0f}{:>14.0f}{:>16.2f}{:>16.2f}'.format(protocol, size, pps, pps * packet_bits(protocol, size), sender_cpu * 1e6, listener_cpu * 1e6))
+
+report = {
+    'tester_version': version(),
+    'time': datetime.datetime.now().isoformat(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'settings': {'period': period, 'max_pps': max_pps, 'max_loss': max_loss, 'args': extra_args},
+    'results': results,
+}
+
+if output:
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+# Show the change in packet rate and CPU time per packet from an earlier run
+if compare:
+    with open(compare) as f:
+        before = json.load(f)
+    old = dict(((r['protocol'], r['size']), r) for r in before['results'])
+    print('')
+    print('Compared with {} (version {})'.format(before['time'], before['tester_version']))
+    print('{:<6}{:>6}{:>12}{:>16}{:>16}'.format('Proto', 'Size', 'pps', 'Sender us/pkt', 'Listener us/pkt'))
+    for r in results:
+        o = old.get((r['protocol'], r['size']))
+        if o:
+            print('{:<6}{:>6}{:>+11.1f}%{:>+15.1f}%{:>+15.1f}%'.format(r['protocol'], r['size'], (r['pps'] / o['pps'] - 1) * 100,
+                (r['sender_cpu_per_packet'] / o['sender_cpu_per_packet'] - 1) * 100, (r['listener_cpu_per_packet'] / o['listener_cpu_per_packet'] - 1) * 100))
@@ -0,0 +1,108 @@
+# Network Tester control channel
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# In a sweep, the sender opens a TCP connection to the listener's port + control_port_offset, and marks each step
+# with messages on it. Each message is a line of ASCII fields separated by spaces:
+#
+#   start <size> <rate> <port>    sender, a step is about to start, sending from the given data port
+#   ready                         listener, counters have been cleared for the step
+#   end <duration> <packets>      sender, the step finished sending this many packets over duration seconds
+#   result <packets> <bytes> <lost> <late> <duplicate>
+#                                 listener, what was received in the step
+#
+# If the listener doesn't accept the connection, the sender falls back to pausing between steps, and the listener
+# works out where each step starts from the packet sizes.
+
+import socket
+import time
+
+control_port_offset = 1
+control_timeout = 5.0 # Longest the sender waits for an answer from the listener
+max_message_length = 1024
+
+class ControlConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.messages = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, *fields):
+        self.sock.sendall((' '.join(str(f) for f in fields) + '\n').encode('ascii'))
+
+    # Read what has arrived on the connection. Returns the complete messages received, as lists of fields, or None
+    # when the connection has been closed.
+    def receive(self):
+        try:
+            data = self.sock.recv(max_message_length)
+        except BlockingIOError:
+            return []
+        except ConnectionError:
+            data = b''
+        if not data:
+            return None
+        self.buffer += data
+        messages = []
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            messages.append(line.decode('ascii', 'replace').split())
+        if len(self.buffer) > max_message_length:
+            return None
+        return messages
+
+    # Wait for the next message. Raises ConnectionError if the connection is closed, or nothing arrives in time.
+    def wait(self, timeout=control_timeout):
+        deadline = time.monotonic() + timeout
+        while not self.messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConnectionError('no answer on the control connection')
+            self.sock.settimeout(remaining)
+            try:
+                messages = self.receive()
+            except socket.timeout:
+                continue
+            if messages == None:
+                raise ConnectionError('control connection closed')
+            self.messages += messages
+        return self.messages.pop(0)
+
+    # Send a message and wait for the answer, which must start with the expected field
+    def request(self, expected, *fields):
+        self.send(*fields)
+        message = self.wait()
+        if (not message) or (message[0] != expected):
+            raise ConnectionError('unexpected answer on the control connection: {}'.format(' '.join(message)))
+        return message
+
+    def close(self):
+        self.sock.close()
+
+# Open the sender's end of the control connection. Returns None if the listener doesn't accept it.
+def connect(server_address, timeout=control_timeout):
+    try:
+        sock = socket.create_connection((server_address[0], server_address[1] + control_port_offset), timeout)
+    except OSError:
+        return None
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return ControlConnection(sock)
+
+# Open the listener's end, a non-blocking listening socket. Returns None if the port can't be used.
+def listen(server_address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((server_address[0], server_address[1] + control_port_offset))
+        sock.listen(1)
+    except OSError:
+        sock.close()
+        return None
+    sock.setblocking(0)
+    return sock
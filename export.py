@@ -0,0 +1,337 @@
+# Network Tester results export
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# With --export the listener writes its results as records, as well as printing them, for other programs to read.
+# At the end of each period there is a record for each flow and one for the total, and a sweep adds one for each
+# step. The records are written as JSON lines, or as CSV with the columns in record_fields, to a file or to a TCP or
+# UDP socket:
+#
+#   results.jsonl             appended to a file, so that a restarted listener carries on where it left off
+#   tcp:10.0.0.5:5170         one line per record on a TCP connection, which is made again if it drops
+#   udp:10.0.0.5:5170         one datagram per record
+#
+# The listener only puts the records on a queue. A writer thread formats and writes them, so a slow disk or a stalled
+# collector never holds up receiving. While the destination can't be written to, records wait on the queue, and if
+# it fills the newest are dropped and counted.
+#
+# With --metrics the listener also serves the results of the last period over HTTP at /metrics, in the Prometheus
+# text format, from another thread. The packet counters of each flow are totals since the listener started, so that
+# nothing is missed between scrapes. A flow is left out once the listener stops tracking it.
+
+import collections
+import copy
+import csv
+import http.server
+import io
+import json
+import queue
+import socket
+import threading
+import time
+
+format_names = ['jsonl', 'csv']
+
+record_fields = ['time', 'type', 'flow', 'size', 'duration', 'packets', 'bytes', 'bps', 'lost', 'late', 'duplicate',
+                 'delay_p50_us', 'delay_p99_us', 'delay_p999_us', 'delay_max_us', 'jitter_us']
+
+max_queued_records = 65536
+retry_interval = 5.0 # Wait before writing again after the destination failed
+connect_timeout = 5.0
+close_timeout = 2.0 # Longest to wait for the queued records to be written when the listener stops
+
+def flow_name(address):
+    return str(address[0]) + ":" + str(address[1])
+
+# Delays of a latency histogram as (p50, p99, p99.9, max), in nanoseconds
+def delay_percentiles(hist):
+    return (hist.percentile(50), hist.percentile(99), hist.percentile(99.9), hist.max)
+
+def parse_port(text):
+    if not text.isdigit() or not (0 < int(text) < 65536):
+        raise ValueError('port must be a number from 1 to 65535')
+    return int(text)
+
+# Read a destination. Returns ('file', path), ('tcp', (host, port)) or ('udp', (host, port)).
+# Raises ValueError if it isn't valid.
+def parse_destination(text):
+    kind = text.split(':', 1)[0]
+    if kind not in ['tcp', 'udp']:
+        return ('file', text)
+    fields = text[len(kind) + 1:].rsplit(':', 1)
+    if (len(fields) != 2) or not fields[0]:
+        raise ValueError('{} destination must be {}:<host>:<port>'.format(kind, kind))
+    return (kind, (fields[0], parse_port(fields[1])))
+
+# Parse an HTTP listening address, given as <port> or <address>:<port>. Raises ValueError if it isn't valid.
+def parse_listen_address(text):
+    fields = text.rsplit(':', 1)
+    if len(fields) == 1:
+        return ('0.0.0.0', parse_port(fields[0]))
+    return (fields[0], parse_port(fields[1]))
+
+# Format records, as lists of values in the order of record_fields, with a header line first for CSV if header
+# is set. Returns a list of lines.
+def format_records(records, format_name, header):
+    lines = []
+    if format_name == 'csv':
+        if header:
+            lines.append(','.join(record_fields) + '\n')
+        for record in records:
+            f = io.StringIO()
+            csv.writer(f, lineterminator='\n').writerow(['' if value == None else value for value in record])
+            lines.append(f.getvalue())
+    else:
+        for record in records:
+            lines.append(json.dumps(collections.OrderedDict((name, value) for name, value in zip(record_fields, record) if value != None),
+                                    separators=(',', ':')) + '\n')
+    return lines
+
+class Exporter:
+    def __init__(self, destination, format_name):
+        self.kind, self.target = destination
+        self.format_name = format_name
+        self.queue = queue.Queue(max_queued_records)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.header_written = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def describe(self):
+        if self.kind == 'file':
+            return self.target
+        return '{}:{}:{}'.format(self.kind, self.target[0], self.target[1])
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # Queue the records of a period. flows is the list passed to print_period, and bps the ethernet bitrate of each.
+    def write_period(self, now, duration, flows, bps, total_bps):
+        now = round(now, 3)
+        total = [0, 0, 0, 0, 0]
+        for (address, packets, nbytes, lost, late, dup, latency, jitter), flow_bps in zip(flows, bps):
+            delays = [None] * 5
+            if latency:
+                delays = [round(d / 1000.0, 1) for d in delay_percentiles(latency)] + [round(jitter / 1000.0, 1)]
+            self.put([now, 'flow', flow_name(address), None, duration, packets, nbytes, int(flow_bps), lost, late, dup] + delays)
+            for x, value in enumerate((packets, nbytes, lost, late, dup)):
+                total[x] += value
+        self.put([now, 'total', None, None, duration, total[0], total[1], int(total_bps)] + total[2:] + [None] * 5)
+        if self.dropped != self.reported_dropped:
+            print('Export to {} is behind, {} records dropped'.format(self.describe(), self.dropped))
+            self.reported_dropped = self.dropped
+
+    # Queue the record of one step of a sweep
+    def write_step(self, now, address, size, packets, nbytes, duration, bps, lost, late, dup):
+        self.put([round(now, 3), 'step', flow_name(address), size, round(duration, 3), packets, nbytes, int(bps), lost, late, dup] + [None] * 5)
+
+    # Write the records that are still queued, giving up after close_timeout
+    def close(self):
+        try:
+            self.queue.put(None, timeout=close_timeout)
+        except queue.Full:
+            return
+        self.thread.join(close_timeout)
+
+    # Open the destination. Returns a function that writes a list of lines to it, and one that closes it.
+    def open(self):
+        if self.kind == 'file':
+            f = open(self.target, 'a')
+            # A file that already has records has its header
+            if f.tell() > 0:
+                self.header_written = True
+            def write(lines):
+                f.write(''.join(lines))
+                f.flush()
+            return write, f.close
+
+        if self.kind == 'tcp':
+            s = socket.create_connection(self.target, connect_timeout)
+            # Every connection starts with a header
+            self.header_written = False
+            def write(lines):
+                s.sendall(''.join(lines).encode('utf-8'))
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(self.target)
+            def write(lines):
+                for line in lines:
+                    s.send(line.encode('utf-8'))
+        return write, s.close
+
+    # The writer thread. Records are written in batches of everything that is queued.
+    def run(self):
+        write = None
+        pending = []
+        failed = False
+        closing = False
+        while True:
+            if not pending:
+                pending.append(self.queue.get())
+            # Records that can't be written yet stay pending, and once there are too many the queue fills instead
+            while len(pending) < max_queued_records:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in pending:
+                closing = True
+                pending = [record for record in pending if record != None]
+
+            try:
+                if write == None:
+                    write, close = self.open()
+                lines = format_records(pending, self.format_name, not(self.header_written))
+                if lines:
+                    write(lines)
+                    self.header_written = True
+                pending = []
+                if failed:
+                    print('Export to {} resumed'.format(self.describe()))
+                    failed = False
+            except OSError as e:
+                if write != None:
+                    close()
+                    write = None
+                if closing:
+                    return
+                if not failed:
+                    print('Export to {} failed ({}), trying again every {:.0f}s'.format(self.describe(), e, retry_interval))
+                    failed = True
+                time.sleep(retry_interval)
+                continue
+
+            if closing:
+                close()
+                return
+
+class FlowMetrics:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicate = 0
+        self.bps = 0
+        self.delays = None # (p50, p99, p99.9, max) in nanoseconds, for flows with timestamps
+        self.jitter = 0.0
+
+# Each metric is (name, type, help, function of a FlowMetrics giving its value)
+flow_counters = [
+    ('networktester_received_packets_total', 'counter', 'Packets received on the flow', lambda m: m.packets),
+    ('networktester_received_bytes_total', 'counter', 'Bytes of payload received on the flow', lambda m: m.bytes),
+    ('networktester_lost_packets_total', 'counter', 'Packets lost on the flow, from gaps in the sequence numbers', lambda m: m.lost),
+    ('networktester_late_packets_total', 'counter', 'Packets received out of order on the flow', lambda m: m.late),
+    ('networktester_duplicate_packets_total', 'counter', 'Packets received more than once on the flow', lambda m: m.duplicate),
+    ('networktester_receive_bits_per_second', 'gauge', 'Ethernet bitrate of the flow over the last period', lambda m: m.bps),
+]
+
+delay_quantiles = ['0.5', '0.99', '0.999', '1']
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    timeout = 10.0
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.format().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not logged
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer:
+    # Serve the metrics on address, a (host, port). Raises OSError if the port can't be opened.
+    def __init__(self, address, exporter=None):
+        self.lock = threading.Lock()
+        self.flows = {}
+        self.periods = 0
+        self.exporter = exporter
+        self.server = http.server.HTTPServer(address, MetricsHandler)
+        self.server.metrics = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    # Add the results of a period. flows is the list passed to print_period, and bps the ethernet bitrate of each.
+    def update(self, flows, bps):
+        with self.lock:
+            self.periods += 1
+            names = set()
+            for (address, packets, nbytes, lost, late, dup, latency, jitter), flow_bps in zip(flows, bps):
+                name = flow_name(address)
+                names.add(name)
+                m = self.flows.get(name)
+                if m == None:
+                    m = FlowMetrics()
+                    self.flows[name] = m
+                m.packets += packets
+                m.bytes += nbytes
+                # A counter must never go down. A late packet comes off the loss of the period it arrives in only
+                # while that is above 0, so one that was lost in an earlier period stays counted as lost, and as late.
+                m.lost += max(lost, 0)
+                m.late += late
+                m.duplicate += dup
+                m.bps = int(flow_bps)
+                m.delays = None
+                if latency:
+                    m.delays = delay_percentiles(latency)
+                    m.jitter = jitter
+            for name in [name for name in self.flows if name not in names]:
+                del self.flows[name]
+
+    def format(self):
+        # The values are copied while the lock is held, as the listener updates them from another thread
+        with self.lock:
+            flows = [(name, copy.copy(m)) for name, m in sorted(self.flows.items())]
+            periods = self.periods
+        lines = []
+        for name, metric_type, description, value in flow_counters:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for flow, m in flows:
+                lines.append('{}{{flow="{}"}} {}'.format(name, escape_label(flow), value(m)))
+
+        lines.append('# HELP networktester_delay_seconds Delay above the flow\'s minimum over the last period, for flows with timestamps')
+        lines.append('# TYPE networktester_delay_seconds gauge')
+        for flow, m in flows:
+            if m.delays:
+                for quantile, delay in zip(delay_quantiles, m.delays):
+                    lines.append('networktester_delay_seconds{{flow="{}",quantile="{}"}} {:.9f}'.format(escape_label(flow), quantile, delay / 1e9))
+        lines.append('# HELP networktester_jitter_seconds Interarrival jitter of the flow, for flows with timestamps')
+        lines.append('# TYPE networktester_jitter_seconds gauge')
+        for flow, m in flows:
+            if m.delays:
+                lines.append('networktester_jitter_seconds{{flow="{}"}} {:.9f}'.format(escape_label(flow), m.jitter / 1e9))
+
+        lines.append('# HELP networktester_flows Flows tracked by the listener')
+        lines.append('# TYPE networktester_flows gauge')
+        lines.append('networktester_flows {}'.format(len(flows)))
+        lines.append('# HELP networktester_periods_total Periods reported since the listener started')
+        lines.append('# TYPE networktester_periods_total counter')
+        lines.append('networktester_periods_total {}'.format(periods))
+        if self.exporter:
+            lines.append('# HELP networktester_export_dropped_records_total Records dropped because the export destination fell behind')
+            lines.append('# TYPE networktester_export_dropped_records_total counter')
+            lines.append('networktester_export_dropped_records_total {}'.format(self.exporter.dropped))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
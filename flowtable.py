@@ -0,0 +1,143 @@
+# Network Tester flow table
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# The listener keeps one Flow per remote address, in a FlowTable ordered by when each flow last received data.
+# Looking up a flow is a dict lookup, and keeping the order is O(1) per update, so the flows that have been idle
+# longest are always at the front of the table. That makes expiring idle flows, and evicting the least recently
+# active flow when the table is full, cheap however many flows there are.
+#
+# Reports list the flows in the order they were first seen, which is kept as a number in each flow.
+#
+# Each flow's period counters are tagged with the period they belong to. Starting a new period just moves the
+# table on to the next period number, and a flow's counters are zeroed the next time it is updated or reported.
+
+import collections
+
+import sequence
+
+default_max_flows = 1024
+default_idle_timeout = 60.0
+
+class Flow:
+    __slots__ = ('number', 'address', 'connection', 'stream', 'tracker', 'start_time', 'last_time', 'packets',
+                 'bytes', 'lost', 'lost_bytes', 'min_offset', 'period_number', 'period_packets', 'period_bytes',
+                 'period_lost', 'period_lost_bytes', 'period_late', 'period_duplicate', 'latency', 'jitter', 'last_transit')
+
+    def __init__(self, number, address, connection, stream, now, period_number):
+        self.number = number
+        self.address = address
+        self.connection = connection # TCP connection, or None for UDP
+        self.stream = stream # TCP receive buffer
+        self.tracker = sequence.SequenceTracker()
+        self.last_time = now
+        self.restart(now, period_number)
+
+    # Zero all of the counters, for a new flow or one whose sender has started again
+    def restart(self, now, period_number):
+        self.start_time = now
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0
+        self.lost_bytes = 0
+        self.min_offset = None # Smallest difference between receive and transmit timestamps
+        self.jitter = 0.0 # Interarrival jitter of timestamped packets, nanoseconds
+        self.last_transit = None
+        self.period_number = period_number
+        self.reset_period()
+
+    def reset_period(self):
+        self.period_packets = 0
+        self.period_bytes = 0
+        self.period_lost = 0
+        self.period_lost_bytes = 0
+        self.period_late = 0
+        self.period_duplicate = 0
+        self.latency = None # Histogram of the delays of timestamped packets
+
+    # Zero the period counters if they are left over from an earlier period
+    def sync(self, period_number):
+        if self.period_number != period_number:
+            self.period_number = period_number
+            self.reset_period()
+
+class FlowTable:
+    def __init__(self, max_flows=default_max_flows, idle_timeout=default_idle_timeout):
+        self.flows = collections.OrderedDict()
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self.period_number = 0
+        self.flows_added = 0
+        self.timeouts = 0 # Flows dropped for being idle
+        self.evictions = 0 # Flows dropped to make room for a new one
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __contains__(self, address):
+        return address in self.flows
+
+    def __iter__(self):
+        return iter(self.flows.values())
+
+    # The addresses of the flows, in the order they were first seen
+    def addresses(self):
+        return [flow.address for flow in sorted(self.flows.values(), key=lambda flow: flow.number)]
+
+    def get(self, address):
+        return self.flows.get(address)
+
+    # Add a flow. The table must not be full, see pop_oldest().
+    def add(self, address, connection, stream, now):
+        flow = Flow(self.flows_added, address, connection, stream, now, self.period_number)
+        self.flows_added += 1
+        self.flows[address] = flow
+        return flow
+
+    def full(self):
+        return len(self.flows) >= self.max_flows
+
+    def remove(self, address):
+        return self.flows.pop(address, None)
+
+    # Remove and return the least recently active flow, to make room in a full table
+    def pop_oldest(self):
+        self.evictions += 1
+        return self.flows.popitem(last=False)[1]
+
+    # Note that a flow has received data, and bring its period counters up to date, before they are updated
+    def update(self, flow, now):
+        flow.last_time = now
+        flow.sync(self.period_number)
+        self.flows.move_to_end(flow.address)
+
+    # Remove and return the flows that have been idle for longer than the idle timeout
+    def expire(self, now):
+        expired = []
+        if self.idle_timeout:
+            while self.flows:
+                flow = next(iter(self.flows.values()))
+                if now - flow.last_time < self.idle_timeout:
+                    break
+                expired.append(self.flows.popitem(last=False)[1])
+        self.timeouts += len(expired)
+        return expired
+
+    # Start a new period for all flows at once
+    def new_period(self):
+        self.period_number += 1
+
+    # The number of flows added, timed out and evicted so far, see ListenerStats.summary()
+    def counts(self):
+        return (self.flows_added, self.timeouts, self.evictions)
+
+    # The flows in the order they were first seen, with their period counters up to date, for reporting the period
+    def period_flows(self):
+        flows = sorted(self.flows.values(), key=lambda flow: flow.number)
+        for flow in flows:
+            flow.sync(self.period_number)
+        return flows
@@ -0,0 +1,95 @@
+# Network Tester latency histogram
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# A log-linear histogram in the style of HdrHistogram. Values below 2^sub_bucket_bits are counted exactly, and
+# above that each power of two is split into 2^(sub_bucket_bits - 1) equal buckets, so every value is recorded
+# with a relative error of less than 2^-(sub_bucket_bits - 1). Memory is fixed when the histogram is created,
+# and recording a value is O(1).
+
+sub_bucket_bits = 7 # Under 1.6% error
+max_value_bits = 42 # Values up to 2^42ns (over an hour) are recorded, larger values are clamped
+
+class LatencyHistogram:
+    def __init__(self):
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count >> 1
+        self.max_value = (1 << max_value_bits) - 1
+        self.counts = [0] * (self.index(self.max_value) + 1)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.max = 0
+
+    # Bucket index for a value. Each power of two above sub_bucket_count adds half_count buckets.
+    def index(self, value):
+        shift = value.bit_length() - sub_bucket_bits
+        if shift <= 0:
+            return value
+        return shift * self.half_count + (value >> shift)
+
+    # Largest value that is counted in a bucket
+    def value_at(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.half_count) // self.half_count
+        return (((index - shift * self.half_count) + 1) << shift) - 1
+
+    # Record a value, normally in nanoseconds. Negative values are counted as 0.
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > self.max_value:
+            value = self.max_value
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    # Add the counts from another histogram, such as one from another worker or shard
+    def merge(self, other):
+        for x in range(len(self.counts)):
+            self.counts[x] += other.counts[x]
+        self.count += other.count
+        if other.max > self.max:
+            self.max = other.max
+
+    # Smallest recorded value that is greater than or equal to the given percentage of the values
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        target = max(int(self.count * percent / 100.0 + 0.5), 1)
+        total = 0
+        for x in range(len(self.counts)):
+            total += self.counts[x]
+            if total >= target:
+                return min(self.value_at(x), self.max)
+        return self.max
+
+    # Only the buckets that have been used are pickled, to keep reports from workers and shards small
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['counts'] = [(x, n) for x, n in enumerate(self.counts) if n]
+        return state
+
+    def __setstate__(self, state):
+        used = state['counts']
+        self.__dict__.update(state)
+        self.counts = [0] * (self.index(self.max_value) + 1)
+        for x, n in used:
+            self.counts[x] = n
+
+def format_time(ns):
+    if ns >= 10000000:
+        return '{:.1f}ms'.format(ns / 1e6)
+    return '{:.1f}us'.format(ns / 1e3)
+
+def format_latency(hist):
+    return 'p50 {} p99 {} p99.9 {} max {} ({} packets)'.format(format_time(hist.percentile(50)), format_time(hist.percentile(99)),
+        format_time(hist.percentile(99.9)), format_time(hist.max), hist.count)
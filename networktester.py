@@ -10,12 +10,31 @@
 
 import socket
 import errno
+import os
 import sys
 import getopt
-import random
 import signal
 import time
-import select
+import selectors
+import queue
+import multiprocessing
+import struct
+import ctypes
+import ctypes.util
+import cProfile
+import traceback
+
+import packetheader
+import pacing
+import payload
+import histogram
+import control
+import flowtable
+import sequence
+import tcpinfo
+import selfstats
+import traffic
+import export
 
 sw_version_number = "1.5"
 
@@ -36,7 +55,56 @@ sweep_max_size = None
 sweep_end = None
 sweep = False
 sweep_delay = 10.0
+max_burst_size = 1024 # Largest number of datagrams handed to the kernel in one burst
+burst_tick = 0.001 # Target interval between bursts when the burst size is derived from the rate
+receive_batch_size = 64 # Number of datagrams received by the listener in one call
+receive_buffer_size = 9216 # Largest datagram the listener accepts, enough for a jumbo frame of any --mtu
+max_drain_batches = 16 # Most batches read per select() wakeup, so that reporting is not held up
+max_select_wait = 1.0 # Longest the listener waits in select(), so that it stops soon after being interrupted
+stream_buffer_size = 262144 # Size of the receive buffer for each TCP connection
+stream_min_read_size = 65536 # Smallest free space at the end of a TCP receive buffer before it is compacted
+max_announced_connections = 10 # New connections listed in each period, any more are only counted
 listen_once = False
+burst = False
+burst_size = None
+workers = 1
+pacer_name = 'schedule'
+payload_name = 'random'
+payload_file = None
+bucket_size = None
+latency = False
+echo = False
+shards = 1
+max_flows = flowtable.default_max_flows
+flow_timeout = flowtable.default_idle_timeout
+find_max = False
+max_loss = 0.0
+find_max_resolution = 0.01 # The search for the maximum rate stops within this fraction of --rate
+trial_settle_time = 2.0 # Wait after each trial for packets still in flight, as RFC 2544 does
+report_timeout = 1.0 # Time to wait for the listener to answer a report request
+report_retries = 3
+step_settle_time = 0.5 # Wait after each sweep step for packets still in flight, before asking for the step's counters
+mtu = 1500 # Largest IP packet on the link, which limits the payload size
+min_mtu = 576
+max_mtu = 9000
+gso = False
+gro = False
+gso_max_segments = 64 # Most datagrams the kernel will split one UDP_SEGMENT send into
+gro_buffer_size = 65535 # A coalesced GRO message can be as large as the largest UDP datagram
+bulk = False
+streams = 1
+write_size = 65536 # Bytes in each write of a bulk transfer, sent as one packet
+send_buffer_size = None # SO_SNDBUF of the sending sockets, None leaves the system default
+socket_receive_buffer_size = None # SO_RCVBUF of the listening socket
+bulk_report_interval = 10.0
+self_stats = False
+profile_file = None
+traffic_file = None
+rx_timestamps = None
+traffic_report_interval = 10.0
+export_destination = None
+export_format = 'jsonl'
+metrics_address = None
 
 def usage():
     print('Usage: networktester.py')
@@ -57,9 +125,37 @@ def usage():
     print('  --stop <sweep end size>')
     print('  --step <sweep step size>')
     print('  --sweep-end <listen ends after this step size>')
+    print('  --burst (send several datagrams per pacing tick, UDP only)')
+    print('  --burst-size <datagrams per burst, default is sized from the rate>')
+    print('  --workers <number of sending processes sharing the rate>')
+    print('  --pacer <{}>'.format('|'.join(pacing.pacer_names)))
+    print('  --payload <random|zeros|repeating|file:<path>>')
+    print('  --bucket-size <packets, for the bucket and timerfd pacers>')
+    print('  --latency (send timestamps, so that the listener can measure delay)')
+    print('  --echo (listener reflects packets back, so that the sender can measure round trip time, UDP only)')
+    print('  --shards <number of listening processes sharing the port>')
+    print('  --find-max (search for the highest rate up to --rate with loss within --max-loss, for each size, UDP only)')
+    print('  --max-loss <percent of packets that may be lost in a --find-max trial, default 0>')
+    print('  --max-flows <most flows the listener tracks, the least recently active is dropped for a new one>')
+    print('  --flow-timeout <seconds before the listener drops an idle flow, 0 to never drop them>')
+    print('  --mtu <largest IP packet on the link, {} to {}, default {}>'.format(min_mtu, max_mtu, mtu))
+    print('  --gso (sender hands the kernel one buffer per burst to split into datagrams, Linux UDP only)')
+    print('  --gro (listener receives datagrams coalesced by the kernel, Linux UDP only)')
+    print('  --bulk (send TCP as fast as the connection takes it, in large writes, --size is not used)')
+    print('  --streams <number of parallel TCP connections for --bulk, default 1>')
+    print('  --write-size <bytes per write for --bulk, default {}>'.format(write_size))
+    print('  --sndbuf <socket send buffer size in bytes>')
+    print('  --rcvbuf <socket receive buffer size in bytes>')
+    print('  --stats (report where the tester\'s own time goes, and the sends and receives the kernel refused or dropped)')
+    print('  --profile <file to save cProfile statistics of the main loop to, with the worker or shard number added>')
+    print('  --traffic <traffic profile file, sends all of the flows it describes, UDP only>')
+    print('  --rx-timestamps <software|hardware> (listener uses the kernel\'s receive time of each packet, Linux UDP only)')
+    print('  --export <file|tcp:<host>:<port>|udp:<host>:<port>> (listener writes the results of each period as records)')
+    print('  --export-format <{}>'.format('|'.join(export.format_names)))
+    print('  --metrics <[address:]port> (listener serves the results over HTTP at /metrics for Prometheus)')
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:],"",["help", "listen", "size=", "address=", "port=", "sendport=", "rate=", "tcp", "period=", "sweep", "start=", "stop=", "step=", "verbose", "steps=", "sweep-end=", "once"])
+    opts, args = getopt.getopt(sys.argv[1:],"",["help", "listen", "size=", "address=", "port=", "sendport=", "rate=", "tcp", "period=", "sweep", "start=", "stop=", "step=", "verbose", "steps=", "sweep-end=", "once", "burst", "burst-size=", "workers=", "pacer=", "payload=", "bucket-size=", "latency", "echo", "shards=", "max-flows=", "flow-timeout=", "find-max", "max-loss=", "mtu=", "gso", "gro", "bulk", "streams=", "write-size=", "sndbuf=", "rcvbuf=", "stats", "profile=", "traffic=", "rx-timestamps=", "export=", "export-format=", "metrics="])
 except getopt.GetoptError:
     usage()
     sys.exit(1)
@@ -95,6 +191,71 @@ for opt, arg in opts:
         sweep_end = int(arg)
     elif opt == "--once":
         listen_once = True
+    elif opt == "--burst":
+        burst = True
+    elif opt == "--burst-size":
+        burst = True
+        burst_size = int(arg)
+    elif opt == "--workers":
+        workers = int(arg)
+    elif opt == "--pacer":
+        pacer_name = arg
+    elif opt == "--payload":
+        payload_name = arg
+        if arg.startswith('file:'):
+            payload_name = 'file'
+            payload_file = arg[5:]
+    elif opt == "--bucket-size":
+        bucket_size = int(arg)
+    elif opt == "--latency":
+        latency = True
+    elif opt == "--echo":
+        echo = True
+        latency = True
+    elif opt == "--shards":
+        shards = int(arg)
+    elif opt == "--max-flows":
+        max_flows = int(arg)
+    elif opt == "--flow-timeout":
+        flow_timeout = float(arg)
+    elif opt == "--find-max":
+        find_max = True
+    elif opt == "--max-loss":
+        max_loss = float(arg)
+    elif opt == "--mtu":
+        mtu = int(arg)
+    elif opt == "--gso":
+        gso = True
+        burst = True
+    elif opt == "--gro":
+        gro = True
+    elif opt == "--bulk":
+        bulk = True
+        use_tcp = True
+    elif opt == "--streams":
+        streams = int(arg)
+        bulk = True
+        use_tcp = True
+    elif opt == "--write-size":
+        write_size = int(arg)
+    elif opt == "--sndbuf":
+        send_buffer_size = int(arg)
+    elif opt == "--rcvbuf":
+        socket_receive_buffer_size = int(arg)
+    elif opt == "--stats":
+        self_stats = True
+    elif opt == "--profile":
+        profile_file = arg
+    elif opt == "--traffic":
+        traffic_file = arg
+    elif opt == "--rx-timestamps":
+        rx_timestamps = arg
+    elif opt == "--export":
+        export_destination = arg
+    elif opt == "--export-format":
+        export_format = arg
+    elif opt == "--metrics":
+        metrics_address = arg
     elif opt == "--verbose":
         verbose = True
     elif opt == "--help":
@@ -103,13 +264,26 @@ for opt, arg in opts:
         sys.exit(1)
 
 # At least 12 bytes is required to hold the magic, length and sequence number fields
-if (packet_size < 12) or ((sweep == True) and sweep_start_size and (sweep_start_size < 12)):
-    print('packet size must be 12 bytes or more')
+if (packet_size < packetheader.header_size) or ((sweep == True) and sweep_start_size and (sweep_start_size < packetheader.header_size)):
+    print('packet size must be {} bytes or more'.format(packetheader.header_size))
+    usage()
+    sys.exit(1)
+
+if latency and not(listen) and ((packet_size < packetheader.timestamp_header_size) or (sweep_step_sizes and (min(sweep_step_sizes) < packetheader.timestamp_header_size)) or ((sweep == True) and sweep_start_size and (sweep_start_size < packetheader.timestamp_header_size))):
+    print('packet size must be {} bytes or more to hold a timestamp'.format(packetheader.timestamp_header_size))
     usage()
     sys.exit(1)
 
-if (packet_size > 1472) or ((sweep == True) and sweep_max_size and (sweep_max_size > 1472)):
-    print('packet size must be 1472 bytes or less')
+if (mtu < min_mtu) or (mtu > max_mtu):
+    print('MTU must be between {} and {}'.format(min_mtu, max_mtu))
+    usage()
+    sys.exit(1)
+
+# The largest payload that fits in one IP packet without fragmenting, after the IP and UDP headers
+max_packet_size = mtu - 28
+
+if not(bulk) and ((packet_size > max_packet_size) or ((sweep == True) and sweep_max_size and (sweep_max_size > max_packet_size)) or (sweep_step_sizes and (max(sweep_step_sizes) > max_packet_size))):
+    print('packet size must be {} bytes or less for an MTU of {}'.format(max_packet_size, mtu))
     usage()
     sys.exit(1)
 
@@ -118,7 +292,168 @@ if (sweep == True) and not(sweep_step_sizes) and not(listen) and (not(sweep_step
     usage()
     sys.exit(1)
 
-if (listen == False) and (address == "0.0.0.0"):
+if echo and use_tcp:
+    print('echo mode is only supported for UDP')
+    usage()
+    sys.exit(1)
+
+if (gso or gro) and (use_tcp or not sys.platform.startswith('linux')):
+    print('GSO and GRO are only supported for UDP on Linux')
+    usage()
+    sys.exit(1)
+
+if rx_timestamps and (rx_timestamps not in ['software', 'hardware']):
+    print('unknown receive timestamps {}'.format(rx_timestamps))
+    usage()
+    sys.exit(1)
+
+if rx_timestamps and (use_tcp or not sys.platform.startswith('linux')):
+    print('kernel receive timestamps are only supported for UDP on Linux')
+    usage()
+    sys.exit(1)
+
+if export_format not in export.format_names:
+    print('unknown export format {}'.format(export_format))
+    usage()
+    sys.exit(1)
+
+if (export_destination or metrics_address) and not(listen):
+    print('--export and --metrics are only supported on the listener')
+    usage()
+    sys.exit(1)
+
+if export_destination:
+    try:
+        export_destination = export.parse_destination(export_destination)
+    except ValueError as e:
+        print('invalid export destination: {}'.format(e))
+        usage()
+        sys.exit(1)
+
+if metrics_address:
+    try:
+        metrics_address = export.parse_listen_address(metrics_address)
+    except ValueError as e:
+        print('invalid metrics address: {}'.format(e))
+        usage()
+        sys.exit(1)
+
+if burst and use_tcp:
+    print('burst mode is only supported for UDP')
+    usage()
+    sys.exit(1)
+
+if burst and (burst_size != None) and ((burst_size < 1) or (burst_size > max_burst_size)):
+    print('burst size must be between 1 and {}'.format(max_burst_size))
+    usage()
+    sys.exit(1)
+
+if streams < 1:
+    print('number of streams must be 1 or more')
+    usage()
+    sys.exit(1)
+
+# Each write is one packet, which the listener must be able to hold in a connection's receive buffer
+if (write_size < packetheader.timestamp_header_size) or (write_size > stream_buffer_size):
+    print('write size must be between {} and {} bytes'.format(packetheader.timestamp_header_size, stream_buffer_size))
+    usage()
+    sys.exit(1)
+
+if bulk and not(listen) and (sweep or find_max or (workers > 1)):
+    print('bulk mode can not be used with a sweep, --find-max or multiple workers')
+    usage()
+    sys.exit(1)
+
+if ((send_buffer_size != None) and (send_buffer_size < 1)) or ((socket_receive_buffer_size != None) and (socket_receive_buffer_size < 1)):
+    print('socket buffer sizes must be 1 byte or more')
+    usage()
+    sys.exit(1)
+
+if workers < 1:
+    print('number of workers must be 1 or more')
+    usage()
+    sys.exit(1)
+
+if (workers > 1) and ('fork' not in multiprocessing.get_all_start_methods()):
+    print('multiple workers are not supported on this platform')
+    usage()
+    sys.exit(1)
+
+if (payload_name not in payload.payload_names) or ((payload_name == 'file') and not(payload_file)):
+    print('unknown payload {}'.format(payload_name))
+    usage()
+    sys.exit(1)
+
+try:
+    payloads = payload.PayloadCache(payload_name, payload_file)
+except (OSError, ValueError) as e:
+    print('can not use payload file: {}'.format(e))
+    usage()
+    sys.exit(1)
+
+if pacer_name not in pacing.pacer_names:
+    print('unknown pacer {}'.format(pacer_name))
+    usage()
+    sys.exit(1)
+
+if (pacer_name == 'timerfd') and not pacing.timerfd_available:
+    print('the timerfd pacer is not supported on this platform')
+    usage()
+    sys.exit(1)
+
+if (bucket_size != None) and (bucket_size < 1):
+    print('bucket size must be 1 or more')
+    usage()
+    sys.exit(1)
+
+if shards < 1:
+    print('number of shards must be 1 or more')
+    usage()
+    sys.exit(1)
+
+if (shards > 1) and (('fork' not in multiprocessing.get_all_start_methods()) or not hasattr(socket, 'SO_REUSEPORT')):
+    print('multiple shards are not supported on this platform')
+    usage()
+    sys.exit(1)
+
+if (shards > 1) and sweep:
+    print('multiple shards can not be used with a sweep')
+    usage()
+    sys.exit(1)
+
+if find_max and (sweep or use_tcp or (workers > 1)):
+    print('--find-max can not be used with a sweep, TCP or multiple workers')
+    usage()
+    sys.exit(1)
+
+if find_max and (bitrate <= 0):
+    print('--find-max needs a maximum rate')
+    usage()
+    sys.exit(1)
+
+if (max_loss < 0) or (max_loss >= 100):
+    print('maximum loss must be from 0 to less than 100 percent')
+    usage()
+    sys.exit(1)
+
+if max_flows < 1:
+    print('maximum number of flows must be 1 or more')
+    usage()
+    sys.exit(1)
+
+# A sweep pauses between steps, so flows must be kept for longer than that
+if (flow_timeout < 0) or (flow_timeout and sweep and (flow_timeout <= sweep_delay)):
+    print('flow timeout must be 0, or more than {} seconds for a sweep'.format(sweep_delay))
+    usage()
+    sys.exit(1)
+
+if traffic_file and not(listen) and (use_tcp or sweep or find_max or burst or echo or (workers > 1)):
+    print('a traffic profile can not be used with TCP, a sweep, --find-max, burst mode, echo or multiple workers')
+    usage()
+    sys.exit(1)
+
+# The flows of a traffic profile have their own addresses
+if (listen == False) and (address == "0.0.0.0") and not(traffic_file):
     print('Invalid address')
     usage()
     sys.exit(1)
@@ -127,9 +462,20 @@ print('4RF Network Tester')
 print('Version {}'.format(sw_version_number))
 print('')
 
+# In bulk mode each write is sent as one packet
+if bulk:
+    packet_size = write_size
+
 if sweep and not(listen) and not(sweep_step_sizes):
     sweep_step_sizes = list(range(sweep_start_size, sweep_max_size, sweep_step_size))
 
+# The maximum rate is found for each size of a sweep if one is given, otherwise just for --size
+if find_max and not(sweep_step_sizes):
+    if sweep_start_size and sweep_max_size and sweep_step_size:
+        sweep_step_sizes = list(range(sweep_start_size, sweep_max_size, sweep_step_size))
+    else:
+        sweep_step_sizes = [packet_size]
+
 # Calculate the size of each packet at the ethernet layer
 udp_overhead = 8
 tcp_overhead = 20
@@ -141,8 +487,34 @@ if use_tcp:
 else:
     proto_overhead = udp_overhead
 
+# Largest TCP segment payload for the MTU
+mss = mtu - ip4_overhead - tcp_overhead
+
+# Bytes added to a packet of size bytes at the ethernet layer. A TCP packet larger than the MSS is carried in
+# several segments, each with its own headers.
+def packet_overhead(size):
+    if use_tcp:
+        return max((size + mss - 1) // mss, 1) * (proto_overhead + ip4_overhead + eth_overhead)
+    return proto_overhead + ip4_overhead + eth_overhead
+
+traffic_flows = None
+if traffic_file and not(listen):
+    try:
+        traffic_flows = traffic.load_flows(traffic_file, address, listen_port_number, packet_overhead,
+            packetheader.timestamp_header_size if latency else packetheader.header_size, max_packet_size)
+    except ValueError as e:
+        print('invalid traffic profile: {}'.format(e))
+        usage()
+        sys.exit(1)
+
 sock = None
+flow_table = None
 exiting = False
+exporter = None
+metrics_server = None
+announced_connections = 0 # New connections listed in this period
+unannounced_connections = 0 # New connections in this period that were only counted
+header_changed = False # The flows have changed since their header was last printed
 
 def signal_handler(signal, frame):
     global sock
@@ -165,32 +537,687 @@ def dodelay(t):
         time.sleep(duration)
         now = time.monotonic()
 
-signal.signal(signal.SIGINT, signal_handler)
+# Structures used to call sendmmsg() and recvmmsg() through ctypes (Linux only)
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
 
-# Create a TCP/IP socket
-if use_tcp:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc_sendmmsg = libc.sendmmsg
+    libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    libc_sendmmsg.restype = ctypes.c_int
+    libc_recvmmsg = libc.recvmmsg
+    libc_recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc_recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    libc_sendmmsg = None
+    libc_recvmmsg = None
+
+sockaddr_in_size = 16
+
+# UDP segmentation and receive offload options (Linux), which the socket module only names in recent versions
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+cmsghdr_struct = struct.Struct('@Nii')
+
+# Kernel receive timestamp options (Linux). SO_TIMESTAMPNS passes a struct timespec with each datagram, and
+# SO_TIMESTAMPING three of them: software, legacy and hardware.
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SO_TIMESTAMPING = getattr(socket, 'SO_TIMESTAMPING', 37)
+SOF_TIMESTAMPING_RX_HARDWARE = 1 << 2
+SOF_TIMESTAMPING_RX_SOFTWARE = 1 << 3
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_RAW_HARDWARE = 1 << 6
+timespec_struct = struct.Struct('@ll')
+timestamping_struct = struct.Struct('@llllll')
+
+# The monotonic clock in nanoseconds, and the difference from the real time clock that kernel timestamps are taken
+# on. Python 3.7 reads the clocks as integer nanoseconds, earlier versions as floats, to within a few hundred ns.
+if hasattr(time, 'time_ns'):
+    def clock_offset_now():
+        now = time.monotonic_ns()
+        return now, time.time_ns() - now
 else:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def clock_offset_now():
+        now = time.monotonic()
+        return int(now * 1e9), int((time.time() - now) * 1e9)
+
+class BurstSender:
+    # Sends a burst of datagrams with one sendmmsg() call where available, otherwise one sendto() per datagram.
+    # The buffers are allocated once per packet size, and only the sequence number is rewritten for each burst.
+    def __init__(self, sock, server_address, packet, count):
+        self.sock = sock
+        self.server_address = server_address
+        self.buffers = [bytearray(packet) for x in range(count)]
+        self.views = []
+        self.mmsg = None
+        self.error = None
+        if libc_sendmmsg:
+            ip = socket.gethostbyname(server_address[0])
+            sockaddr = struct.pack('=H', socket.AF_INET) + struct.pack('!H', server_address[1]) + socket.inet_aton(ip) + bytes(8)
+            self.sockaddr = ctypes.create_string_buffer(sockaddr, len(sockaddr))
+            self.iov = (iovec * count)()
+            self.mmsg = (mmsghdr * count)()
+            for x in range(count):
+                self.views.append((ctypes.c_char * len(packet)).from_buffer(self.buffers[x]))
+                self.iov[x].iov_base = ctypes.addressof(self.views[x])
+                self.iov[x].iov_len = len(packet)
+                self.mmsg[x].msg_hdr.msg_name = ctypes.addressof(self.sockaddr)
+                self.mmsg[x].msg_hdr.msg_namelen = len(sockaddr)
+                self.mmsg[x].msg_hdr.msg_iov = ctypes.pointer(self.iov[x])
+                self.mmsg[x].msg_hdr.msg_iovlen = 1
 
-def add_connection(connection, client_address):
-    global connection_list
+    # Send the whole burst, numbering the packets from sequence_number + 1, and giving them all the same transmit
+    # timestamp if there is one. Returns the number actually sent, and if none were, error is the reason.
+    def send(self, sequence_number, timestamp=None):
+        for buf in self.buffers:
+            sequence_number += 1
+            packetheader.pack_sequence(buf, sequence_number)
+            if timestamp != None:
+                packetheader.pack_timestamp(buf, timestamp)
+
+        if self.mmsg:
+            ret = libc_sendmmsg(self.sock.fileno(), self.mmsg, len(self.buffers), 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    self.error = err
+                    return 0
+                raise OSError(err, os.strerror(err))
+            return ret
+
+        sent = 0
+        for buf in self.buffers:
+            try:
+                self.sock.sendto(buf, self.server_address)
+            except BlockingIOError:
+                self.error = errno.EAGAIN
+                break
+            sent += 1
+        return sent
+
+class GsoSender:
+    # Sends a burst with a single sendto() of all of the packets laid end to end in one buffer. The socket's
+    # UDP_SEGMENT option has the kernel split the buffer into datagrams of the packet size, so the whole burst
+    # goes through the send path once. Raises OSError if the kernel doesn't support it.
+    def __init__(self, sock, server_address, packet, count):
+        self.sock = sock
+        self.server_address = server_address
+        self.size = len(packet)
+        self.buffer = bytearray(packet) * count
+        self.views = [memoryview(self.buffer)[x * self.size:(x + 1) * self.size] for x in range(count)]
+        self.error = None
+        self.sent = False
+        sock.setsockopt(SOL_UDP, UDP_SEGMENT, self.size)
+
+    # The largest burst of packets of size bytes that the kernel will take in one send
+    @staticmethod
+    def max_count(size):
+        return max(min(gso_max_segments, 65507 // size), 1)
+
+    # Send the whole burst, as BurstSender.send(). Returns the number of packets sent, all or none.
+    def send(self, sequence_number, timestamp=None):
+        for view in self.views:
+            sequence_number += 1
+            packetheader.pack_sequence(view, sequence_number)
+            if timestamp != None:
+                packetheader.pack_timestamp(view, timestamp)
+        try:
+            self.sock.sendto(self.buffer, self.server_address)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                self.error = e.errno
+                return 0
+            raise
+        self.sent = True
+        return len(self.views)
 
-    print('Got connection from', client_address)
+    # Whether an error from send() means the device can't do GSO. A device without checksum offload fails the first
+    # send with EIO, and one that rejects the segments with EINVAL.
+    def unsupported(self, e):
+        return not(self.sent) and (e.errno in (errno.EIO, errno.EINVAL))
 
-    c = [connection, time.monotonic(), 0, 0, 0, 0, None, 0, 0, 0, 0, None]
-    connection_list[client_address] = c
+    # Stop the kernel segmenting the socket's sends
+    def disable(self):
+        self.sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
 
+class BurstReceiver:
+    # Receives a batch of datagrams into a pool of buffers that is allocated once, using one recvmmsg() call
+    # where available, otherwise one recvfrom_into() per datagram. The buffers are consecutive slots of size bytes
+    # in one pool, so that all of the headers can be decoded together. After receive() returns n, offsets[0:n],
+    # lengths[0:n] and addresses[0:n] describe the datagrams in the pool, which are only valid until the next
+    # receive().
+    #
+    # With gro the socket must have UDP_GRO set. The kernel may then coalesce datagrams from one sender into a
+    # single message, which is split back into its datagrams using the segment size passed with it, so n can be
+    # more than count.
+    #
+    # With timestamping set to the option enabled on the socket (SO_TIMESTAMPNS or SO_TIMESTAMPING), times[0:n]
+    # are the times the kernel received the datagrams, in nanoseconds on the monotonic clock. The kernel's
+    # timestamps are on the real time clock, and are moved to the monotonic clock by the difference between the
+    # two when the batch is received.
+    def __init__(self, sock, count, size, gro=False, timestamping=None):
+        self.sock = sock
+        self.count = count
+        self.size = size
+        self.gro = gro
+        self.timestamping = timestamping
+        # With GRO the last datagram of a message can end just short of the end of the pool, so leave room to
+        # read a header after it
+        self.pool = bytearray(count * size + (packetheader.header_size if gro else 0))
+        self.pool_view = memoryview(self.pool)
+        self.views = [self.pool_view[x * size:(x + 1) * size] for x in range(count)]
+        self.offsets = [x * size for x in range(count)]
+        self.message_lengths = [0] * count
+        self.message_addresses = [None] * count
+        self.message_times = [0] * count
+        self.lengths = self.message_lengths
+        self.addresses = self.message_addresses
+        self.times = self.message_times
+        self.segment_sizes = [0] * count
+        self.control_size = 0
+        if gro:
+            self.control_size += socket.CMSG_SPACE(4)
+        if timestamping == SO_TIMESTAMPNS:
+            self.control_size += socket.CMSG_SPACE(timespec_struct.size)
+        elif timestamping == SO_TIMESTAMPING:
+            self.control_size += socket.CMSG_SPACE(timestamping_struct.size)
+        self.address_cache = {}
+        self.mmsg = None
+        if libc_recvmmsg:
+            self.c_pool = (ctypes.c_char * len(self.pool)).from_buffer(self.pool)
+            self.names = bytearray(sockaddr_in_size * count)
+            self.c_names = (ctypes.c_char * len(self.names)).from_buffer(self.names)
+            self.iov = (iovec * count)()
+            self.mmsg = (mmsghdr * count)()
+            for x in range(count):
+                self.iov[x].iov_base = ctypes.addressof(self.c_pool) + x * size
+                self.iov[x].iov_len = size
+                self.mmsg[x].msg_hdr.msg_name = ctypes.addressof(self.c_names) + x * sockaddr_in_size
+                self.mmsg[x].msg_hdr.msg_namelen = sockaddr_in_size
+                self.mmsg[x].msg_hdr.msg_iov = ctypes.pointer(self.iov[x])
+                self.mmsg[x].msg_hdr.msg_iovlen = 1
+            if self.control_size:
+                self.controls = bytearray(self.control_size * count)
+                self.c_controls = (ctypes.c_char * len(self.controls)).from_buffer(self.controls)
+                for x in range(count):
+                    self.mmsg[x].msg_hdr.msg_control = ctypes.addressof(self.c_controls) + x * self.control_size
+                    self.mmsg[x].msg_hdr.msg_controllen = self.control_size
+            # The kernel overwrites msg_namelen, msg_controllen and msg_flags, so keep a copy to restore before each call
+            self.mmsg_template = ctypes.create_string_buffer(bytes(self.mmsg), ctypes.sizeof(self.mmsg))
+
+    # Note one item of a message's ancillary data, of the given level and type, found at offset in buf. Items cut
+    # short because the control buffer was too small are ignored.
+    def read_control(self, x, level, cmsg_type, buf, offset, length):
+        if (level == SOL_UDP) and (cmsg_type == UDP_GRO) and (length >= 4):
+            self.segment_sizes[x] = struct.unpack_from('@i', buf, offset)[0]
+        elif (level == socket.SOL_SOCKET) and (cmsg_type == SO_TIMESTAMPNS) and (self.timestamping == SO_TIMESTAMPNS) and (length >= timespec_struct.size):
+            sec, nsec = timespec_struct.unpack_from(buf, offset)
+            self.message_times[x] = sec * 1000000000 + nsec - self.clock_offset
+        elif (level == socket.SOL_SOCKET) and (cmsg_type == SO_TIMESTAMPING) and (self.timestamping == SO_TIMESTAMPING) and (length >= timestamping_struct.size):
+            # Software, legacy and hardware timestamps. The hardware timestamp is only there if the NIC made one.
+            sw_sec, sw_nsec, legacy_sec, legacy_nsec, hw_sec, hw_nsec = timestamping_struct.unpack_from(buf, offset)
+            if hw_sec or hw_nsec:
+                self.message_times[x] = hw_sec * 1000000000 + hw_nsec - self.clock_offset
+            elif sw_sec or sw_nsec:
+                self.message_times[x] = sw_sec * 1000000000 + sw_nsec - self.clock_offset
+
+    # Receive up to count datagrams without blocking. Returns the number received.
+    def receive(self):
+        if self.timestamping:
+            # Messages without a timestamp are given the time they were read
+            now, self.clock_offset = clock_offset_now()
+        if self.mmsg:
+            ctypes.memmove(self.mmsg, self.mmsg_template, ctypes.sizeof(self.mmsg))
+            ret = libc_recvmmsg(self.sock.fileno(), self.mmsg, self.count, 0, None)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return 0
+                raise OSError(err, os.strerror(err))
+            for x in range(ret):
+                self.message_lengths[x] = self.mmsg[x].msg_len
+                # Source addresses are cached, so a known sender costs a lookup rather than building a new tuple
+                key = struct.unpack_from('!HI', self.names, x * sockaddr_in_size + 2)
+                address = self.address_cache.get(key)
+                if address == None:
+                    address = (socket.inet_ntoa(struct.pack('!I', key[1])), key[0])
+                    self.address_cache[key] = address
+                self.message_addresses[x] = address
+                if self.control_size:
+                    self.segment_sizes[x] = 0
+                    self.message_times[x] = now if self.timestamping else 0
+                    # Walk through the ancillary data items of the message
+                    offset = x * self.control_size
+                    end = offset + self.mmsg[x].msg_hdr.msg_controllen
+                    while offset + socket.CMSG_LEN(0) <= end:
+                        cmsg_len, level, cmsg_type = cmsghdr_struct.unpack_from(self.controls, offset)
+                        if (cmsg_len < socket.CMSG_LEN(0)) or (offset + cmsg_len > end):
+                            break
+                        self.read_control(x, level, cmsg_type, self.controls, offset + socket.CMSG_LEN(0), cmsg_len - socket.CMSG_LEN(0))
+                        offset += socket.CMSG_SPACE(cmsg_len - socket.CMSG_LEN(0))
+            if self.gro:
+                return self.split(ret)
+            return ret
+
+        received = 0
+        while received < self.count:
+            try:
+                if self.control_size:
+                    self.message_lengths[received], ancdata, flags, self.message_addresses[received] = self.sock.recvmsg_into([self.views[received]], self.control_size)
+                    self.segment_sizes[received] = 0
+                    self.message_times[received] = now if self.timestamping else 0
+                    for level, cmsg_type, data in ancdata:
+                        self.read_control(received, level, cmsg_type, data, 0, len(data))
+                else:
+                    self.message_lengths[received], self.message_addresses[received] = self.sock.recvfrom_into(self.views[received])
+            except BlockingIOError:
+                break
+            received += 1
+        if self.gro:
+            return self.split(received)
+        return received
+
+    # Split the coalesced messages into their datagrams, all of the segment size apart from the last in each
+    # message, and all with the message's timestamp. Returns the number of datagrams.
+    def split(self, count):
+        offsets = []
+        lengths = []
+        addresses = []
+        times = []
+        for x in range(count):
+            length = self.message_lengths[x]
+            address = self.message_addresses[x]
+            rx_time = self.message_times[x]
+            segment_size = self.segment_sizes[x]
+            if (segment_size <= 0) or (segment_size >= length):
+                offsets.append(x * self.size)
+                lengths.append(length)
+                addresses.append(address)
+                times.append(rx_time)
+                continue
+            for offset in range(0, length, segment_size):
+                offsets.append(x * self.size + offset)
+                lengths.append(min(segment_size, length - offset))
+                addresses.append(address)
+                times.append(rx_time)
+        self.offsets = offsets
+        self.lengths = lengths
+        self.addresses = addresses
+        self.times = times
+        return len(offsets)
+
+class StreamBuffer:
+    # Receive buffer for one TCP connection. Data is read straight into the free space after the end offset, and
+    # packets are consumed by advancing the start offset. The unconsumed bytes are only moved back to the start of
+    # the buffer when the free space at the end gets too small for a worthwhile read.
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    # Read whatever is waiting on the connection. Returns the number of bytes read, or 0 if the connection closed.
+    def receive(self, connection):
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        elif len(self.buffer) - self.end < stream_min_read_size:
+            remaining = self.end - self.start
+            self.view[0:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        length = connection.recv_into(self.view[self.end:])
+        self.end += length
+        return length
+
+    # Throw away everything that has been received, after the stream has lost its framing
+    def discard(self):
+        self.start = self.end
+
+signal.signal(signal.SIGINT, signal_handler)
+
+def print_connection_header(addresses):
     if sweep:
-        print("{:<22}{:>14}{:>12}{:>9}{:>10}{:>11}".format('Address', 'Payload Size', 'Total Size', 'Packets', 'Duration', 'Speed bps'))
+        print("{:<22}{:>14}{:>12}{:>9}{:>10}{:>11}{:>8}{:>8}{:>8}".format('Address', 'Payload Size', 'Total Size', 'Packets', 'Duration', 'Speed bps', 'Lost', 'Late', 'Dup'))
     else:
         s = "{:<21}".format("Total (bps)")
-        for c in connection_list:
-            s += "{:<21}".format(str(c[0])+":"+str(c[1]))
+        for c in addresses:
+            s += "{:<21}{:<8}{:<8}{:<8}".format(str(c[0])+":"+str(c[1]), 'Lost', 'Late', 'Dup')
         print(s)
 
-if listen == False:
-    print('Period =', period)
+# Many senders starting at once would swamp the output, and printing the header again for each of them takes time
+# that grows with the number of flows. So only the first few new connections of a period are listed, and the header
+# is printed once at the end of the period if the flows have changed.
+def announce_connection(address):
+    global announced_connections, unannounced_connections, header_changed
+    if announced_connections < max_announced_connections:
+        print('Got connection from', address)
+        announced_connections += 1
+    else:
+        unannounced_connections += 1
+    header_changed = True
+
+# The columns of the flows that are left move when flows are removed, so their header is printed again
+def flows_removed():
+    global header_changed
+    header_changed = True
+
+# Print the connections that were only counted, and the header if the flows have changed, before a period's results
+def print_connection_changes(addresses):
+    global announced_connections, unannounced_connections, header_changed
+    if unannounced_connections:
+        print('Got {} more connections'.format(unannounced_connections))
+    if header_changed and addresses:
+        print_connection_header(addresses)
+    announced_connections = 0
+    unannounced_connections = 0
+    header_changed = False
+
+# Add a flow to the table, making room by dropping the least recently active flow if it is full. Returns the new
+# flow. A shard of the listener leaves announcing it to the coordinating process.
+def add_connection(selector, connection, client_address, now, announce=True):
+    if flow_table.full():
+        close_flow(selector, flow_table.pop_oldest(), 'Dropped, too many flows')
+
+    stream = None
+    if connection:
+        stream = StreamBuffer(stream_buffer_size)
+    flow = flow_table.add(client_address, connection, stream, now)
+
+    if announce:
+        if sweep:
+            print('Got connection from', client_address)
+            print_connection_header(flow_table.addresses())
+        else:
+            announce_connection(client_address)
+    return flow
+
+# Clean up after a flow that has been taken out of the table. TCP connections are closed.
+def close_flow(selector, flow, reason):
+    if flow.connection or verbose:
+        print('{}: {}'.format(str(flow.address[0])+":"+str(flow.address[1]), reason))
+    if flow.connection:
+        selector.unregister(flow.connection)
+        flow.connection.close()
+
+# Record the delay of a timestamped packet. The clocks of the sender and the listener are not synchronised, so
+# the delay is measured from the smallest difference between the receive and transmit times seen on the flow,
+# which leaves the delay added by queueing under load. The interarrival jitter is estimated as in RFC 3550, from
+# the change in transit time between consecutive packets, which doesn't depend on the clocks being synchronised.
+def record_latency(flow, rx_timestamp, tx_timestamp):
+    offset = rx_timestamp - tx_timestamp
+    if flow.last_transit != None:
+        flow.jitter += (abs(offset - flow.last_transit) - flow.jitter) / 16.0
+    flow.last_transit = offset
+    if (flow.min_offset == None) or (offset < flow.min_offset):
+        flow.min_offset = offset
+    if flow.latency == None:
+        flow.latency = histogram.LatencyHistogram()
+    flow.latency.record(offset - flow.min_offset)
+
+# Classify a packet's sequence number, and count the packets lost, late and duplicated in the flow. A late packet
+# was counted as lost when it was skipped over, so is taken off the loss again. It may have been counted in an
+# earlier period, so the period's loss is never taken below 0. Returns True if the sender has started again, in
+# which case the flow's counters start again too.
+def record_sequence(flow, seq, length, now):
+    result = flow.tracker.record(seq)
+    if result > 0:
+        flow.period_lost += result
+        flow.period_lost_bytes += result * length
+        flow.lost += result
+        flow.lost_bytes += result * length
+    elif result == sequence.late:
+        if flow.period_lost > 0:
+            flow.period_lost -= 1
+            flow.period_lost_bytes = max(flow.period_lost_bytes - length, 0)
+        flow.lost -= 1
+        flow.lost_bytes -= length
+        flow.period_late += 1
+    elif result == sequence.duplicate:
+        flow.period_duplicate += 1
+    elif result == sequence.restart:
+        print('{}: Reconnected'.format(str(flow.address[0])+":"+str(flow.address[1])))
+        flow.restart(now, flow_table.period_number)
+        return True
+    return False
+
+# Print one row of a sweep's results for a flow
+def print_sweep_step(address, size, packets, nbytes, duration, lost, late, dup):
+    bps = 0
+    if duration > 0:
+        bps = (nbytes + packets * packet_overhead(size)) * 8.0 / duration
+    print('{:<22}{:>14}{:>12}{:>9}{:>10.2f}{:>11}{:>8}{:>8}{:>8}'.format(str(address[0])+":"+str(address[1]), size, size + packet_overhead(size), packets, duration, int(bps),
+        lost, late, dup))
+    if exporter:
+        exporter.write_step(time.time(), address, size, packets, nbytes, duration, bps, lost, late, dup)
+
+# Print the throughput and sequence errors of each flow over the last period, with the total throughput first,
+# followed by the delay and jitter of any flows that sent timestamps, and with --stats where the listener's time
+# went. flows is a list of (address, packets, bytes, lost, late, duplicate, latency histogram or None, jitter).
+# The results are also passed to --export and --metrics.
+def print_period(flows, listener_stats):
+    s = ""
+    total_bps = 0
+    bps = []
+    for address, packets, nbytes, lost, late, dup, latency, jitter in flows:
+        # Flows can mix packet sizes, so the overhead is worked out from the average
+        bps_period = nbytes * 8.0 / period
+        if packets > 0:
+            bps_period += packets * packet_overhead(nbytes // packets) * 8.0 / period
+        total_bps += bps_period
+        bps.append(bps_period)
+        s += '{:<21}{:<8}{:<8}{:<8}'.format(int(bps_period), lost, late, dup)
+    print('{:<21}'.format(int(total_bps)) + s)
+    for address, packets, nbytes, lost, late, dup, latency, jitter in flows:
+        if latency:
+            print('{}: delay above minimum {}, jitter {:.1f}us'.format(str(address[0])+":"+str(address[1]), histogram.format_latency(latency), jitter / 1000.0))
+    if listener_stats:
+        print(selfstats.format_listener(listener_stats, sum(f[1] for f in flows)))
+    export_period(flows, bps, total_bps)
+
+# Pass the results of a period to --export and --metrics. bps is the ethernet bitrate of each flow.
+def export_period(flows, bps, total_bps):
+    if exporter:
+        exporter.write_period(time.time(), period, flows, bps, total_bps)
+    if metrics_server:
+        metrics_server.update(flows, bps)
+
+# Start --export and --metrics, in the process that prints the results
+def start_export():
+    global exporter
+    global metrics_server
+
+    if export_destination:
+        exporter = export.Exporter(export_destination, export_format)
+        print('Exporting results to {} as {}'.format(exporter.describe(), export_format))
+    if metrics_address:
+        try:
+            metrics_server = export.MetricsServer(metrics_address, exporter)
+            print('Serving metrics on http://{}:{}/metrics'.format(metrics_address[0], metrics_address[1]))
+        except OSError as e:
+            print('Can not serve metrics on {} port {} ({})'.format(metrics_address[0], metrics_address[1], e))
+
+# Write the results still waiting to be exported, and stop serving metrics
+def stop_export():
+    if exporter:
+        exporter.close()
+    if metrics_server:
+        metrics_server.close()
+
+# Print how much was sent in one measurement period, with --verbose how evenly it was paced, in echo mode
+# the round trip times of the packets reflected back by the listener, and with --stats where the time went
+def print_sent(packet_size, measure_bytes, duration, bps, gaps, rtt, sender_stats):
+    print('Sent {} packets of {} bytes in {:.2f}s = {:.0f} bps'.format(measure_bytes / packet_size, packet_size, duration, bps))
+    if verbose:
+        print(pacing.format_summary(gaps))
+    if rtt:
+        print('Round trip {}'.format(histogram.format_latency(rtt)))
+    if sender_stats:
+        print(selfstats.format_sender(sender_stats))
+
+# Report how much was sent in one measurement period. Workers pass their counters to the parent process,
+# which prints a single combined line for all workers.
+def report_sent(worker, report_queue, report_number, packet_size, measure_bytes, duration, pacer, rtt, stats):
+    packet_size_eth_bits = (packet_size + packet_overhead(packet_size)) * 8
+    bps = measure_bytes * packet_size_eth_bits / packet_size / duration
+    gaps = pacer.stats.summary()
+    pacer.stats.reset()
+    sender_stats = None
+    if self_stats:
+        # How far the packets sent are behind the number the rate called for by now
+        lag = 0
+        if pacer.interval > 0:
+            lag = max(duration - measure_bytes / packet_size * pacer.interval, 0)
+        sender_stats = stats.summary(lag)
+    stats.reset()
+    if report_queue:
+        report_queue.put((worker, report_number, packet_size, measure_bytes, duration, bps, gaps, rtt, sender_stats))
+    else:
+        print_sent(packet_size, measure_bytes, duration, bps, gaps, rtt, sender_stats)
+
+# Count a send that the socket refused, by the reason
+def count_send_error(stats, err):
+    if err == errno.ENOBUFS:
+        stats.no_buffers += 1
+    else:
+        stats.would_block += 1
+
+# Read the packets reflected back by a listener in echo mode, and record their round trip times. If timestamped,
+# each echo is timed by the kernel's receive timestamp (SO_TIMESTAMPNS) where it has one.
+def receive_echoes(sock, buf, rtt, timestamped):
+    now = None
+    while True:
+        rx_time = None
+        try:
+            if timestamped:
+                length, ancdata, flags, echo_address = sock.recvmsg_into([buf], echo_control_size)
+                for level, cmsg_type, data in ancdata:
+                    if (level == socket.SOL_SOCKET) and (cmsg_type == SO_TIMESTAMPNS) and (len(data) >= timespec_struct.size):
+                        if now == None:
+                            now, clock_offset = clock_offset_now()
+                        sec, nsec = timespec_struct.unpack_from(data)
+                        rx_time = sec * 1000000000 + nsec - clock_offset
+            else:
+                length = sock.recv_into(buf)
+        except OSError:
+            return
+        magic, version, pktlen, seq = packetheader.unpack_header(buf)
+        if (length >= packetheader.timestamp_header_size) and (magic == packetheader.magic_number) and (version >= packetheader.timestamp_version):
+            if rx_time == None:
+                if now == None:
+                    now = packetheader.timestamp_now()
+                rx_time = now
+            rtt.record(rx_time - packetheader.unpack_timestamp(buf))
+
+# Ancillary data space for the kernel's receive timestamp of an echo
+echo_control_size = socket.CMSG_SPACE(timespec_struct.size) if hasattr(socket, 'CMSG_SPACE') else 0
+
+# Ask the listener how many packets it has received from this socket. Returns None if it doesn't answer.
+def query_received(sock, server_address, request_number):
+    request = bytearray(packetheader.header_size)
+    packetheader.pack_header(request, packetheader.header_size, request_number, packetheader.report_request_version)
+    reply = bytearray(receive_buffer_size)
+    try:
+        for attempt in range(report_retries):
+            sock.sendto(request, server_address)
+            deadline = time.monotonic() + report_timeout
+            while time.monotonic() < deadline:
+                sock.settimeout(deadline - time.monotonic())
+                try:
+                    length = sock.recv_into(reply)
+                except socket.timeout:
+                    break
+                # Skip anything else that arrives, such as echoed packets
+                magic, version, pktlen, seq = packetheader.unpack_header(reply)
+                if (length >= packetheader.report_size) and (magic == packetheader.magic_number) and (version == packetheader.report_version) and (seq == request_number & 0xFFFFFFFF):
+                    return packetheader.unpack_report(reply)
+    finally:
+        sock.setblocking(0)
+    return None
+
+# Answer a listener report request for the number of packets received on a flow
+def send_report(sock, address, request_number, packets):
+    reply = bytearray(packetheader.report_size)
+    packetheader.pack_header(reply, packetheader.report_size, request_number, packetheader.report_version)
+    packetheader.pack_report(reply, packets)
+    try:
+        sock.sendto(reply, address)
+    except OSError:
+        pass
+
+class RateSearch:
+    # Binary search for the highest rate up to max_rate that passes a trial. Each trial narrows the range between
+    # the highest rate that passed and the lowest that failed, until it is no wider than resolution.
+    def __init__(self, max_rate, resolution):
+        self.low = 0
+        self.high = max_rate
+        self.rate = max_rate
+        self.resolution = resolution
+
+    # Record the result of a trial at self.rate. Returns True when the search is finished, and self.low is the
+    # highest rate that passed (0 if none did), otherwise self.rate is the next rate to try.
+    def result(self, passed):
+        if passed:
+            self.low = self.rate
+        else:
+            self.high = self.rate
+        if self.high - self.low <= self.resolution:
+            return True
+        self.rate = (self.low + self.high) / 2.0
+        return False
+
+# Print the highest rate found for each size by --find-max
+def print_find_max(results):
+    print("{:>14}{:>12}{:>16}".format('Payload Size', 'Total Size', 'Max rate bps'))
+    for size, rate in results:
+        print("{:>14}{:>12}{:>16.0f}".format(size, size + packet_overhead(size), rate))
+
+# Set a socket buffer size given on the command line. The kernel may round or limit the size, so the size it
+# actually uses is printed.
+def set_socket_buffer(s, option, size, name, announce=True):
+    if size == None:
+        return
+    s.setsockopt(socket.SOL_SOCKET, option, size)
+    if announce:
+        print('Socket {} buffer = {} bytes'.format(name, s.getsockopt(socket.SOL_SOCKET, option)))
+
+# Run one of the main loops, with --profile under cProfile, saving the statistics when it finishes. Each worker or
+# shard saves to its own file, with its number added to the name.
+def run_profiled(number, function, *args):
+    if not profile_file:
+        return function(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        path = profile_file
+        if number != None:
+            path = '{}.{}'.format(profile_file, number)
+        profiler.dump_stats(path)
+        print('Profile saved to {}'.format(path))
+
+# Send packets to the listener until stopped, or until the end of the sweep. When running as one of several
+# workers, each worker uses its own socket and sends its share of the rate.
+def run_sender(packet_size, bitrate, worker=None, report_queue=None, start_event=None):
+    global sock
+
+    send_port = send_port_number
+    if send_port and (worker != None):
+        send_port += worker
+    # Only the first worker prints the details of what is being sent
+    announce = (worker == None) or (worker == 0)
+    use_gso = gso
 
     # Create a TCP/IP socket
     if use_tcp:
@@ -199,44 +1226,106 @@ if listen == False:
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
     else:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    set_socket_buffer(sock, socket.SO_SNDBUF, send_buffer_size, 'send', announce)
 
     # Connect the socket to the port where the server is listening
     server_address = (address, listen_port_number)
-    print('Connecting to %s port %s' % server_address)
     if use_tcp:
         sock.connect(server_address)
     else:
-        sock.bind(("0.0.0.0", send_port_number))
+        sock.bind(("0.0.0.0", send_port))
     sock.setblocking(0)
     
-    if sweep:
+    if sweep or find_max:
         packet_size = sweep_step_sizes[0]
-        print('Sweeping payload size from {} bytes to {} bytes (plus ethernet overhead of {} bytes'.format(sweep_step_sizes[0], sweep_step_sizes[-1], proto_overhead + ip4_overhead + eth_overhead) )
-    
-    print('Ethernet bitrate = {:.0f} bps'.format(bitrate))
+    rate = bitrate
+    if find_max:
+        search = RateSearch(bitrate, bitrate * find_max_resolution)
+        results = []
+
+    # Build the packets for every size up front, so that changing size doesn't hold up pacing
+    if sweep or find_max:
+        payloads.prepare(sweep_step_sizes)
+    else:
+        payloads.prepare([packet_size])
+
+    pacer = pacing.create_pacer(pacer_name, dodelay, bucket_size)
+    stats = selfstats.SenderStats()
+    rtt = None
+    echo_timestamps = False
+    if echo:
+        rtt = histogram.LatencyHistogram()
+        echo_buffer = bytearray(receive_buffer_size)
+        # The echoes are only read between sends, after the pacer has waited, so on Linux the kernel times each echo
+        # as it arrives. Elsewhere an echo is timed when it is read, which adds up to the gap between packets.
+        if sys.platform.startswith('linux'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                echo_timestamps = True
+            except OSError:
+                pass
+    if latency:
+        header_version = packetheader.timestamp_version
+    else:
+        header_version = packetheader.header_version
+
+    # A single sender marks the steps of a sweep over a control connection, so that the listener counts each step
+    # exactly and the steps can follow each other without a pause
+    controller = None
+    if sweep and (worker == None):
+        controller = control.connect(server_address)
+        if controller == None:
+            print('No control connection to the listener, pausing {:.0f}s between steps'.format(sweep_delay))
+
+    if start_event:
+        start_event.wait()
 
-    this_delay_time = delay_time
+    report_number = 0
+    failed = False
     
     try:
-        total_time = 0
-        packets_sent = 0
+        # Each trial of --find-max is measured by the change in the number of packets the listener has received
+        if find_max:
+            received_before = query_received(sock, server_address, report_number)
+            if received_before == None:
+                print('No answer from the listener to a report request')
+                return
+        
         total_data_sent = 0
         sequence_number = 0
         measure_start_time = time.monotonic()
         measure_bytes = 0
         last_packet_size = 0
+        last_rate = rate
         sweep_period_start_time = time.monotonic()
         while True:
             try:
                 current_time = time.monotonic()
                 
-                if (not(sweep) and (current_time - measure_start_time >= 10.0)):
-                    print('Sent {} packets of {} bytes in {:.2f}s = {:.0f} bps'.format(measure_bytes / packet_size, packet_size, current_time - measure_start_time, measure_bytes * packet_size_eth_bits / packet_size / (current_time - measure_start_time)))
+                if (not(sweep) and not(find_max) and (current_time - measure_start_time >= 10.0)):
+                    report_sent(worker, report_queue, report_number, packet_size, measure_bytes, current_time - measure_start_time, pacer, rtt, stats)
+                    if echo:
+                        rtt = histogram.LatencyHistogram()
+                    report_number += 1
                     measure_bytes = 0
                     measure_start_time = current_time
 
-                if sweep and (time.monotonic() - sweep_period_start_time > period):
-                    print('Sent {} packets of {} bytes in {:.2f}s = {:.0f} bps'.format(measure_bytes / packet_size, packet_size, current_time - measure_start_time, measure_bytes * packet_size_eth_bits / packet_size / (current_time - measure_start_time)))
+                if sweep and (current_time - sweep_period_start_time > period):
+                    report_sent(worker, report_queue, report_number, packet_size, measure_bytes, current_time - measure_start_time, pacer, rtt, stats)
+                    if echo:
+                        rtt = histogram.LatencyHistogram()
+                    report_number += 1
+                    
+                    # Wait for the packets still in flight, and ask the listener what it received in the step
+                    if controller:
+                        dodelay(step_settle_time)
+                        try:
+                            result = controller.request('result', 'end', '{:.6f}'.format(current_time - measure_start_time), measure_bytes // packet_size)
+                            print('Received {} packets, lost {}, late {}, duplicate {}'.format(result[1], result[3], result[4], result[5]))
+                        except (OSError, ConnectionError, IndexError) as e:
+                            print('Control connection failed: {}'.format(e))
+                            controller.close()
+                            controller = None
                     
                     cindex = sweep_step_sizes.index(packet_size)
                     if cindex < len(sweep_step_sizes)-1:
@@ -244,94 +1333,503 @@ if listen == False:
                     else:
                         break
                     
-                    dodelay(sweep_delay)
+                    if not controller:
+                        dodelay(sweep_delay)
                     measure_bytes = 0
                     measure_start_time = time.monotonic()
+                    stats.reset()
+                
+                if find_max and (current_time - sweep_period_start_time > period):
+                    # Wait for the packets still in flight, then find out how many arrived
+                    sent = measure_bytes // packet_size
+                    dodelay(trial_settle_time)
+                    report_number += 1
+                    received_after = query_received(sock, server_address, report_number)
+                    if received_after == None:
+                        print('No answer from the listener to a report request')
+                        break
+                    lost = max(sent - (received_after - received_before), 0)
+                    received_before = received_after
+                    passed = (sent > 0) and (lost * 100.0 <= sent * max_loss)
+                    print('Trial at {:.0f} bps: sent {} packets, lost {} ({:.3f}%), {}'.format(rate, sent, lost, lost * 100.0 / max(sent, 1), 'pass' if passed else 'fail'))
+                    
+                    if search.result(passed):
+                        print('Maximum rate for {} bytes = {:.0f} bps'.format(packet_size, search.low))
+                        results.append((packet_size, search.low))
+                        cindex = sweep_step_sizes.index(packet_size)
+                        if cindex < len(sweep_step_sizes)-1:
+                            packet_size = sweep_step_sizes[cindex+1]
+                        else:
+                            print_find_max(results)
+                            break
+                        search = RateSearch(bitrate, bitrate * find_max_resolution)
+                    rate = search.rate
+                    measure_bytes = 0
+                    measure_start_time = time.monotonic()
+                    stats.reset()
                 
                 # Send data
-                if last_packet_size != packet_size:
-                    packets_sent = 0
-                    start_time = time.monotonic()
+                if (last_packet_size != packet_size) or (last_rate != rate):
+                    packet_size_eth_bits = (packet_size + packet_overhead(packet_size)) * 8
+                    if rate > 0:
+                        delay_time = float(packet_size_eth_bits) / float(rate)
+                    else:
+                        delay_time = 0
+                    if announce and (last_packet_size != packet_size):
+                        print('Sending payload = {} bytes (plus ethernet overhead {} bytes)'.format(packet_size, packet_size_eth_bits / 8))
                     last_packet_size = packet_size
-                    packet_size_eth_bits = (packet_size + proto_overhead + ip4_overhead + eth_overhead) * 8
-                    delay_time = float(packet_size_eth_bits) / float(bitrate)
-                    print('Sending payload = {} bytes (plus ethernet overhead {} bytes)'.format(packet_size, packet_size_eth_bits / 8))
+                    last_rate = rate
                     #print('Delay between packets = {:.02f} ms'.format(delay_time * 1000.0))
                     
-                    # Each packet contains a magic number (4 bytes), a length (4 bytes), and remaining bytes are random
-                    packet = bytearray(packet_size)
-                    for x in range(0, packet_size):
-                        packet[x] = random.randint(0,255)
-                    packet[0] = 0xBA
-                    packet[1] = 0xAD
-                    packet[2] = 0xF0
-                    packet[3] = 0x0D
-                    packet[4] = (packet_size >> 24) & 0xFF
-                    packet[5] = (packet_size >> 16) & 0xFF
-                    packet[6] = (packet_size >> 8) & 0xFF
-                    packet[7] = (packet_size >> 0) & 0xFF
+                    # Each packet contains a magic number (4 bytes), a version and length (4 bytes), a sequence number
+                    # (4 bytes), and remaining bytes are the payload pattern
+                    packet = payloads.get(packet_size)
+                    packetheader.pack_header(packet, packet_size, 0, header_version)
+                    
+                    # Tell the listener the next step is starting, and wait until it is ready to count it
+                    if controller:
+                        try:
+                            controller.request('ready', 'start', packet_size, int(rate), sock.getsockname()[1])
+                            measure_start_time = time.monotonic()
+                        except (OSError, ConnectionError) as e:
+                            print('Control connection failed: {}'.format(e))
+                            controller.close()
+                            controller = None
+                    
+                    # In burst mode send enough packets per burst to keep roughly one burst per burst_tick
+                    if burst:
+                        if burst_size:
+                            this_burst_size = burst_size
+                        elif rate > 0:
+                            this_burst_size = min(max(int(burst_tick / delay_time), 1), max_burst_size)
+                        else:
+                            this_burst_size = max_burst_size
+                        burst_sender = None
+                        if use_gso:
+                            this_burst_size = min(this_burst_size, GsoSender.max_count(packet_size))
+                            try:
+                                burst_sender = GsoSender(sock, server_address, packet, this_burst_size)
+                                if announce:
+                                    print('Sending bursts of {} packets with UDP GSO'.format(this_burst_size))
+                            except OSError as e:
+                                print('UDP GSO is not available ({}), sending bursts without it'.format(e))
+                                use_gso = False
+                        if burst_sender == None:
+                            burst_sender = BurstSender(sock, server_address, packet, this_burst_size)
+                            if announce:
+                                print('Sending bursts of {} packets{}'.format(this_burst_size, '' if burst_sender.mmsg else ' (sendmmsg not available)'))
+                        pacer.start(delay_time, this_burst_size)
+                    else:
+                        pacer.start(delay_time, 1)
                     
                     sweep_period_start_time = time.monotonic()
                 
-                sequence_number += 1
-                packet[8] = (sequence_number >> 24) & 0xFF
-                packet[9] = (sequence_number >> 16) & 0xFF
-                packet[10] = (sequence_number >> 8) & 0xFF
-                packet[11] = (sequence_number >> 0) & 0xFF
-                
-                total_data_sent += packet_size
-                if use_tcp:
-                    sent_data = 0
-                    while (sent_data < packet_size):
-                        try:
-                            ret = sock.send(packet[sent_data:])
-                            sent_data += ret
-                        except socket.error as e:
-                            if e.args[0] != errno.EWOULDBLOCK:
-                                raise e
-                            dodelay(0.01)
-                else:
-                    sock.sendto(packet, server_address)
-                measure_bytes += packet_size
-                packets_sent += 1
-
-                # Delay enough to make average message rate what is requested, correcting for loop overhead and imprecise delay function
-                if bitrate > 0:
-                    elapsed_time = time.monotonic() - start_time
-                    expected_elapsed_time = packets_sent * delay_time
-                    if expected_elapsed_time > elapsed_time:
-                        this_delay_time = expected_elapsed_time - elapsed_time
+                if burst:
+                    if self_stats:
+                        send_start = time.perf_counter()
+                    try:
+                        sent = burst_sender.send(sequence_number, packetheader.timestamp_now() if latency else None)
+                    except OSError as e:
+                        # The kernel accepts UDP_SEGMENT before it knows whether the device can send the segments,
+                        # so if the first send fails the rest of the run sends bursts without GSO
+                        if not(use_gso) or not(burst_sender.unsupported(e)):
+                            raise
+                        print('UDP GSO is not available ({}), sending bursts without it'.format(e))
+                        burst_sender.disable()
+                        use_gso = False
+                        burst_sender = BurstSender(sock, server_address, packet, this_burst_size)
+                        if announce:
+                            print('Sending bursts of {} packets{}'.format(this_burst_size, '' if burst_sender.mmsg else ' (sendmmsg not available)'))
+                        continue
+                    if self_stats:
+                        pace_start = time.perf_counter()
+                        stats.send_time += pace_start - send_start
+                        stats.send_calls += 1
+                    sequence_number += sent
+                    total_data_sent += sent * packet_size
+                    measure_bytes += sent * packet_size
+                    if sent > 0:
+                        pacer.pace(sent)
                     else:
-                        this_delay_time = 0
+                        # Socket buffer is full, give the kernel a chance to drain it
+                        count_send_error(stats, burst_sender.error)
+                        dodelay(0.001)
+                    if self_stats:
+                        stats.pace_time += time.perf_counter() - pace_start
                 else:
-                    this_delay_time = 0
-                if this_delay_time > 0:
-                    dodelay(this_delay_time)
-                current_time = time.monotonic()
+                    packetheader.pack_sequence(packet, sequence_number + 1)
+                    if latency:
+                        packetheader.pack_timestamp(packet, packetheader.timestamp_now())
+                    
+                    if self_stats:
+                        send_start = time.perf_counter()
+                    sent = 1
+                    if use_tcp:
+                        sent_data = 0
+                        while (sent_data < packet_size):
+                            try:
+                                ret = sock.send(packet[sent_data:])
+                                sent_data += ret
+                            except socket.error as e:
+                                if e.args[0] != errno.EWOULDBLOCK:
+                                    raise e
+                                stats.would_block += 1
+                                dodelay(0.01)
+                    else:
+                        # A datagram the socket can't take is not sent, and its sequence number is used for the next
+                        try:
+                            sock.sendto(packet, server_address)
+                        except OSError as e:
+                            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                                raise
+                            count_send_error(stats, e.errno)
+                            sent = 0
+                    if self_stats:
+                        pace_start = time.perf_counter()
+                        stats.send_time += pace_start - send_start
+                        stats.send_calls += 1
+                    
+                    if sent:
+                        sequence_number += 1
+                        total_data_sent += packet_size
+                        measure_bytes += packet_size
+                        # Delay enough to make average message rate what is requested
+                        pacer.pace(1)
+                    else:
+                        # Socket buffer is full, give the kernel a chance to drain it
+                        dodelay(0.001)
+                    if self_stats:
+                        stats.pace_time += time.perf_counter() - pace_start
+                
+                if echo:
+                    receive_echoes(sock, echo_buffer, rtt, echo_timestamps)
+            except Exception:
+                # Interrupting the sender closes its socket, which ends the loop. Any other error is reported, and a
+                # worker exits with an error so that the parent process notices.
+                if exiting:
+                    break
+                traceback.print_exc()
+                failed = True
+                break
             except:
                 break
 
     finally:
-        print('Closing socket')
+        if announce:
+            print('Closing socket')
+        if controller:
+            controller.close()
         sock.close()
-    
-else:
-    # Bind the socket to the port
+    if failed:
+        sys.exit(1)
+
+class BulkStream:
+    # One connection of a bulk TCP transfer. Each write is one packet, numbered in the connection's own sequence,
+    # and a write that the kernel only takes part of carries on from where it stopped when the socket is writable.
+    def __init__(self, number, sock, packet):
+        self.number = number
+        self.sock = sock
+        self.packet = bytearray(packet)
+        self.view = memoryview(self.packet)
+        self.offset = 0
+        self.sequence_number = 0
+        self.measure_bytes = 0
+        self.retransmits = 0
+
+# Print each stream's goodput over the last report interval, with the kernel's statistics for the connection where
+# they are available, followed by the total
+def print_bulk(bulk_streams, duration):
+    total_bytes = 0
+    for stream in bulk_streams:
+        total_bytes += stream.measure_bytes
+        s = 'Stream {}: {:.0f} bps goodput'.format(stream.number, stream.measure_bytes * 8.0 / duration)
+        info = tcpinfo.read(stream.sock)
+        if info:
+            s += ', ' + tcpinfo.format_info(info, info['total_retrans'] - stream.retransmits)
+            stream.retransmits = info['total_retrans']
+        print(s)
+        stream.measure_bytes = 0
+    print('Sent {} bytes on {} streams in {:.2f}s = {:.0f} bps goodput, {:.0f} bps ethernet'.format(total_bytes, len(bulk_streams), duration,
+        total_bytes * 8.0 / duration, (total_bytes + total_bytes / packet_size * packet_overhead(packet_size)) * 8.0 / duration))
+
+# Send to the listener over several TCP connections at once, in writes of packet_size bytes, as fast as the
+# connections take them or paced to the rate shared between them. The connections are non-blocking and written to
+# as each becomes writable, so one process can keep them all busy.
+def run_bulk_sender(bitrate):
     server_address = (address, listen_port_number)
-    print('Listening on %s port %s' % server_address)
-    if sweep:
-        print('Average period = {:.1f}'.format(period))
-    print('')
-    
+    packet = payloads.get(packet_size)
+    if latency:
+        packetheader.pack_header(packet, packet_size, 0, packetheader.timestamp_version)
+    else:
+        packetheader.pack_header(packet, packet_size, 0)
+
+    selector = selectors.DefaultSelector()
+    bulk_streams = []
+    try:
+        for x in range(streams):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            set_socket_buffer(s, socket.SO_SNDBUF, send_buffer_size, 'send', x == 0)
+            if send_port_number:
+                s.bind(("0.0.0.0", send_port_number + x))
+            s.connect(server_address)
+            s.setblocking(0)
+            stream = BulkStream(x + 1, s, packet)
+            selector.register(s, selectors.EVENT_WRITE, stream)
+            bulk_streams.append(stream)
+
+        pacer = pacing.create_pacer(pacer_name, dodelay, bucket_size)
+        delay_time = 0
+        if bitrate > 0:
+            delay_time = (packet_size + packet_overhead(packet_size)) * 8.0 / bitrate
+        pacer.start(delay_time, 1)
+        print('Sending {} byte writes on {} streams'.format(packet_size, streams))
+
+        measure_start_time = time.monotonic()
+        while not exiting:
+            current_time = time.monotonic()
+            if current_time - measure_start_time >= bulk_report_interval:
+                print_bulk(bulk_streams, current_time - measure_start_time)
+                measure_start_time = current_time
+
+            # select() carries on waiting after a signal, so wait no more than max_select_wait to notice exiting
+            for key, mask in selector.select(max_select_wait):
+                stream = key.data
+                # Number and timestamp each packet before its first byte is written
+                if stream.offset == 0:
+                    packetheader.pack_sequence(stream.packet, stream.sequence_number + 1)
+                    if latency:
+                        packetheader.pack_timestamp(stream.packet, packetheader.timestamp_now())
+                try:
+                    sent = stream.sock.send(stream.view[stream.offset:])
+                except BlockingIOError:
+                    continue
+                stream.offset += sent
+                stream.measure_bytes += sent
+                if stream.offset == packet_size:
+                    stream.offset = 0
+                    stream.sequence_number += 1
+                    pacer.pace(1)
+    except OSError as e:
+        if not exiting:
+            print('Connection failed: {}'.format(e))
+    finally:
+        print('Closing socket')
+        for stream in bulk_streams:
+            stream.sock.close()
+        selector.close()
+
+# Print what each flow of a traffic profile sent over the last report interval, then the total
+def print_traffic(flows, duration):
+    total_packets = 0
+    total_bits = 0
+    for flow in flows:
+        s = '{}: sent {} packets to {}:{}, average {} bytes = {:.0f} bps'.format(flow.name, flow.measure_packets, flow.address[0], flow.address[1],
+            flow.measure_bytes // max(flow.measure_packets, 1), flow.measure_bits / duration)
+        if flow.would_block:
+            s += ', would block {}'.format(flow.would_block)
+        print(s)
+        total_packets += flow.measure_packets
+        total_bits += flow.measure_bits
+        flow.measure_packets = 0
+        flow.measure_bytes = 0
+        flow.measure_bits = 0
+        flow.would_block = 0
+    print('Sent {} packets on {} flows in {:.2f}s = {:.0f} bps'.format(total_packets, len(flows), duration, total_bits / duration))
+
+# Send all of the flows of a traffic profile from one process, each from its own socket with its own sequence
+# numbers, taking the packets in the order they fall due
+def run_traffic():
+    if latency:
+        header_version = packetheader.timestamp_version
+    else:
+        header_version = packetheader.header_version
+    payloads.prepare(sorted(set(size for flow in traffic_flows for size in flow.sizes)))
+
+    try:
+        for x, flow in enumerate(traffic_flows):
+            flow.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            set_socket_buffer(flow.sock, socket.SO_SNDBUF, send_buffer_size, 'send', x == 0)
+            if send_port_number:
+                flow.sock.bind(("0.0.0.0", send_port_number + x))
+            flow.sock.setblocking(0)
+        print('Sending {} flows'.format(len(traffic_flows)))
+
+        scheduler = traffic.Scheduler(traffic_flows, time.monotonic())
+        measure_start_time = time.monotonic()
+        while not exiting:
+            now = time.monotonic()
+            if now - measure_start_time >= traffic_report_interval:
+                print_traffic(traffic_flows, now - measure_start_time)
+                measure_start_time = now
+
+            due, number = scheduler.next()
+            if due > now:
+                dodelay(min(due - now, max_select_wait))
+                continue
+
+            flow = traffic_flows[number]
+            size = flow.next_size()
+            packet = payloads.get(size)
+            packetheader.pack_header(packet, size, flow.sequence_number + 1, header_version)
+            if latency:
+                packetheader.pack_timestamp(packet, packetheader.timestamp_now())
+            # A datagram the socket can't take is not sent, and its sequence number is used for the next
+            try:
+                flow.sock.sendto(packet, flow.address)
+                flow.sequence_number += 1
+                flow.measure_packets += 1
+                flow.measure_bytes += size
+                flow.measure_bits += flow.bits[size]
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    raise
+                flow.would_block += 1
+            scheduler.reschedule(flow.next_departure(due, size, now), number)
+    except OSError as e:
+        if not exiting:
+            print('Send failed: {}'.format(e))
+    finally:
+        print('Closing socket')
+        for flow in traffic_flows:
+            if flow.sock:
+                flow.sock.close()
+
+# The numbers of the worker or shard processes that have stopped with an error, such as an exception or a signal
+def failed_processes(processes):
+    return [x for x, p in enumerate(processes) if not(p.is_alive()) and (p.exitcode != 0)]
+
+# Run the sender in several worker processes, and combine the counters they report into one line per period
+def run_workers():
+    ctx = multiprocessing.get_context('fork')
+    report_queue = ctx.Queue()
+    start_event = ctx.Event()
+    processes = []
+    for x in range(workers):
+        processes.append(ctx.Process(target=run_profiled, args=(x, run_sender, packet_size, bitrate / workers, x, report_queue, start_event)))
+        processes[-1].start()
+    # Start all the workers together, so that they step through a sweep at the same time
+    start_event.set()
+
+    # Reports are only complete while every worker is running, so the others are stopped if one fails
+    reports = {}
+    failed = []
+    while True:
+        try:
+            report = report_queue.get(timeout=0.1)
+        except queue.Empty:
+            failed = failed_processes(processes)
+            if failed:
+                print('Worker {} stopped unexpectedly, stopping the other workers'.format(failed[0] + 1))
+                break
+            if exiting or not any(p.is_alive() for p in processes):
+                break
+            continue
+        report_number = report[1]
+        reports.setdefault(report_number, []).append(report)
+        if len(reports[report_number]) == workers:
+            r = reports.pop(report_number)
+            rtt = None
+            if echo:
+                rtt = histogram.LatencyHistogram()
+                for x in r:
+                    rtt.merge(x[7])
+            sender_stats = None
+            if self_stats:
+                sender_stats = selfstats.combine_sender([x[8] for x in r])
+            print_sent(r[0][2], sum(x[3] for x in r), max(x[4] for x in r), sum(x[5] for x in r), pacing.combine_summaries([x[6] for x in r]), rtt, sender_stats)
+
+    for p in processes:
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGINT)
+        p.join()
+    if failed:
+        sys.exit(1)
+
+# Receive from the senders and report the throughput of each flow. When running as one of several shards, the
+# counters for each period are passed to the coordinating process instead of being printed.
+def run_listener(server_address, shard=None, report_queue=None, start_event=None):
+    global sock
+    global flow_table
+
+    # Create a TCP/IP socket
+    if use_tcp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # All of the shards bind the same port, and the kernel spreads the flows between them
+    if shard != None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    set_socket_buffer(sock, socket.SO_RCVBUF, socket_receive_buffer_size, 'receive', shard == None or shard == 0)
+
+    # Bind the socket to the port
     sock.bind(server_address)
     sock.setblocking(0)
     
     if use_tcp:
         # Listen for incoming connections
-        sock.listen(1)
+        sock.listen(socket.SOMAXCONN)
+
+    # Each socket is registered once, rather than building a list of sockets to wait on for every read
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
 
-    connection_list = {}
+    # A sender can mark the steps of a sweep over a control connection, otherwise they are found from packet sizes
+    control_sock = None
+    controller = None
+    step_address = None
+    if sweep:
+        control_sock = control.listen(server_address)
+        if control_sock:
+            selector.register(control_sock, selectors.EVENT_READ)
+        else:
+            print('Control port {} is not available'.format(server_address[1] + control.control_port_offset))
+
+    flow_table = flowtable.FlowTable(max_flows, flow_timeout)
+    stats = selfstats.ListenerStats()
+    flow_counts_before = flow_table.counts()
+    drops_before = None
+    if self_stats and not(use_tcp):
+        drops_before = selfstats.read_udp_drops(sock)
+    announce = report_queue == None
+    report_number = 0
+    
+    if not use_tcp:
+        # With GRO the kernel passes up coalesced datagrams, so each buffer must hold the largest it can make
+        use_gro = gro
+        if use_gro:
+            try:
+                sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+            except OSError as e:
+                print('UDP GRO is not available ({}), receiving without it'.format(e))
+                use_gro = False
+        # The kernel's receive timestamps, rather than the time each batch is read, give the arrival time of packets
+        timestamping = None
+        if rx_timestamps:
+            try:
+                if rx_timestamps == 'hardware':
+                    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING, SOF_TIMESTAMPING_RX_HARDWARE | SOF_TIMESTAMPING_RAW_HARDWARE |
+                                    SOF_TIMESTAMPING_RX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE)
+                    timestamping = SO_TIMESTAMPING
+                else:
+                    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                    timestamping = SO_TIMESTAMPNS
+            except OSError as e:
+                print('Kernel receive timestamps are not available ({}), timing packets when they are read'.format(e))
+        if use_gro:
+            receiver = BurstReceiver(sock, receive_batch_size, gro_buffer_size, True, timestamping)
+        else:
+            receiver = BurstReceiver(sock, receive_batch_size, receive_buffer_size, False, timestamping)
+    rx_index = 0
+    rx_count = 0
+    rx_times = None
+    failed = False
     
+    # Shards start together, so that their periods line up
+    if start_event:
+        start_event.wait()
+
     total_start_time = None
     start_time = time.monotonic()
     sweep_rx_length = 0
@@ -340,55 +1838,54 @@ else:
     last_rx_time = 0
     this_rx_time = 0
 
-    while True:
+    while not exiting:
         try:
             current_time = time.monotonic()
             if (sweep == False) and ((current_time - start_time) >= period):
                 start_time += period
                 
-                total_bytes = 0
-                total_packets = 0
-                period_bytes = 0
-                period_packets = 0
-                period_dropped_bytes = 0
-                total_dropped_bytes = 0
+                flows = []
+                for f in flow_table.period_flows():
+                    flows.append((f.address, f.period_packets, f.period_bytes, f.period_lost, f.period_late, f.period_duplicate, f.latency, f.jitter))
+                flow_table.new_period()
                 
-                s = ""
-                for c in connection_list:
-                    total_packets += connection_list[c][2]
-                    total_bytes += connection_list[c][3]
-                    period_packets += connection_list[c][4]
-                    period_bytes += connection_list[c][5]
-                    period_dropped_bytes += connection_list[c][8]
-                    total_dropped_bytes += connection_list[c][10]
-                    
-                    bps_period = (connection_list[c][5] + connection_list[c][4] * (proto_overhead + ip4_overhead + eth_overhead)) * 8.0 / period
-                    bps_total = (connection_list[c][3] + connection_list[c][2] * (proto_overhead + ip4_overhead + eth_overhead)) * 8.0 / (current_time - connection_list[c][1])
-                    s += '{:<21}'.format(int(bps_period))
-                    
-                    connection_list[c][4] = 0
-                    connection_list[c][5] = 0
-                    connection_list[c][7] = 0
-                    connection_list[c][8] = 0
+                listener_stats = None
+                if self_stats:
+                    drops = None
+                    if drops_before != None:
+                        drops_after = selfstats.read_udp_drops(sock)
+                        if drops_after != None:
+                            drops = drops_after - drops_before
+                            drops_before = drops_after
+                    flow_counts = flow_table.counts()
+                    listener_stats = stats.summary(drops, [n - b for n, b in zip(flow_counts, flow_counts_before)])
+                    flow_counts_before = flow_counts
+                stats.reset()
                 
-                if total_start_time != None:
-                    bps_period = (period_bytes + period_packets * (proto_overhead + ip4_overhead + eth_overhead)) * 8.0 / period
-                    bps_total = (total_bytes + total_packets * (proto_overhead + ip4_overhead + eth_overhead)) * 8.0 / (current_time - total_start_time)
-
-                    s = '{:<21}'.format(int(bps_period)) + s
+                if report_queue:
+                    report_queue.put((shard, report_number, flows, listener_stats))
+                    report_number += 1
+                elif total_start_time != None:
+                    print_connection_changes([f[0] for f in flows])
+                    print_period(flows, listener_stats)
                 else:
-                    s = 'Waiting for connection...'
-                print(s)
+                    print_connection_changes([])
+                    print('Waiting for connection...')
+                    if listener_stats:
+                        print(selfstats.format_listener(listener_stats, 0))
+                    export_period([], [], 0)
                 
-                if listen_once:
+                if listen_once and announce:
                     sys.exit(0)
             
-            elif (sweep == True) and ((last_rx_length != sweep_rx_length) or (time.monotonic() - last_rx_time > sweep_delay)):
+            elif (sweep == True) and (controller == None) and ((last_rx_length != sweep_rx_length) or (time.monotonic() - last_rx_time > sweep_delay)):
+                new_step = last_rx_length != sweep_rx_length
                 if sweep_rx_length != 0:
-                    for c in connection_list:
+                    for f in flow_table.period_flows():
+                        c = f.address
                         # Latest packet is different size. So subtract from total, and use time up till previous packet as averaging period
-                        period_num_packets = connection_list[c][4] - 1
-                        period_total_data = connection_list[c][5] - last_rx_length
+                        period_num_packets = f.period_packets - 1
+                        period_total_data = f.period_bytes - last_rx_length
                         if last_rx_length == sweep_rx_length:
                             period_num_packets -= 1
                             period_total_data -= last_rx_length
@@ -396,137 +1893,415 @@ else:
                         calc_period = last_rx_time - start_time
                         #print period_num_packets, period_total_data, calc_period
                         if period_num_packets > 0:
-                            bps_period = (period_total_data + period_num_packets * (proto_overhead + ip4_overhead + eth_overhead)) * 8.0 / calc_period
-                            print('{:<22}{:>14}{:>12}{:>9}{:>10.2f}{:>11}'.format(str(c[0])+":"+str(c[1]), sweep_rx_length, sweep_rx_length + proto_overhead + ip4_overhead + eth_overhead, period_num_packets, calc_period, int(bps_period)))
-                        
-                        connection_list[c][4] = 0
-                        connection_list[c][5] = 0
-                        connection_list[c][7] = 0
-                        connection_list[c][8] = 0
+                            print_sweep_step(c, sweep_rx_length, period_num_packets, period_total_data, calc_period, f.period_lost, f.period_late, f.period_duplicate)
+                    flow_table.new_period()
                         
                 if sweep_end and (sweep_end == sweep_rx_length):
                     break
                 sweep_rx_length = last_rx_length
                 start_time = time.monotonic()
+                # With kernel timestamps the step starts when its first packet arrived, rather than when it was read
+                if rx_times and new_step:
+                    start_time = this_rx_time
+            
+            # Drop the flows that have been idle for too long, oldest first
+            expired = flow_table.expire(current_time)
+            for f in expired:
+                close_flow(selector, f, 'Timed out')
+            if expired:
+                if not flow_table:
+                    total_start_time = None
+                if announce:
+                    flows_removed()
     
-            # Wait for data, timing out after 100ms
-            check_list = []
-            if use_tcp:
-                for c in connection_list:
-                    check_list.append(connection_list[c][0])
-            check_list.append(sock)
-            ready_to_read, ready_to_write, in_error = select.select(check_list, [], [], 0.1)
+            # Wait for data until the end of the period, so that the period is reported on time. A sweep is driven by
+            # the data received, so checks every 100ms. Don't wait if part of the last batch is still to be processed.
+            # select() carries on waiting after a signal, so wait no more than max_select_wait to notice exiting.
+            if rx_index < rx_count:
+                timeout = 0
+            elif sweep:
+                timeout = 0.1
+            else:
+                timeout = min(max(start_time + period - time.monotonic(), 0), max_select_wait)
+            if self_stats:
+                select_start = time.perf_counter()
+                events = selector.select(timeout)
+                stats.idle_time += time.perf_counter() - select_start
+            else:
+                events = selector.select(timeout)
+            listener_ready = False
+            sweep_finished = False
+            for key, mask in events:
+                if key.fileobj is sock:
+                    listener_ready = True
+                elif key.fileobj is control_sock:
+                    # Only one sender at a time can control the sweep
+                    try:
+                        connection, control_address = control_sock.accept()
+                    except BlockingIOError:
+                        continue
+                    if controller:
+                        connection.close()
+                        continue
+                    connection.setblocking(0)
+                    controller = control.ControlConnection(connection)
+                    selector.register(connection, selectors.EVENT_READ, controller)
+                elif isinstance(key.data, control.ControlConnection):
+                    messages = controller.receive()
+                    # The messages come from the network, so one that can't be parsed drops the control connection
+                    # rather than stopping the listener
+                    try:
+                        for message in messages or []:
+                            if (len(message) == 4) and (message[0] == 'start'):
+                                # Clear the counters, and note which flow the step is sent on
+                                step_size = int(message[1])
+                                step_address = (controller.sock.getpeername()[0], int(message[3]))
+                                sweep_rx_length = step_size
+                                flow_table.new_period()
+                                controller.send('ready')
+                            elif (len(message) == 3) and (message[0] == 'end') and step_address:
+                                # The step's duration is measured by the sender, from the start of the step to its last packet
+                                duration = float(message[1])
+                                f = flow_table.get(step_address)
+                                counters = (0, 0, 0, 0, 0)
+                                if f:
+                                    f.sync(flow_table.period_number)
+                                    counters = (f.period_packets, f.period_bytes, f.period_lost, f.period_late, f.period_duplicate)
+                                print_sweep_step(step_address, step_size, counters[0], counters[1], duration, counters[2], counters[3], counters[4])
+                                controller.send('result', *counters)
+                                flow_table.new_period()
+                                step_address = None
+                                if sweep_end and (sweep_end == step_size):
+                                    sweep_finished = True
+                            else:
+                                print('Unexpected control message: {}'.format(' '.join(message)))
+                    except (ValueError, IndexError):
+                        print('Unexpected control message: {}'.format(' '.join(message)))
+                        messages = None
+                    except OSError:
+                        # The sender has gone
+                        messages = None
+                    if messages == None:
+                        selector.unregister(controller.sock)
+                        controller.close()
+                        controller = None
+                        step_address = None
+                        sweep_rx_length = 0
+            if sweep_finished:
+                break
             
-            if use_tcp and (sock in ready_to_read):
-                ready_to_read.remove(sock)
-                connection, client_address = sock.accept()
-                add_connection(connection, client_address)
-
-                if total_start_time == None:
-                    start_time = time.monotonic()
-                    total_start_time = time.monotonic()
-
-            for connection in ready_to_read:
-                # Read a single datagram from one remote host
-                if use_tcp:
-                    address = connection.getpeername()
-                    readdata = bytearray(connection.recv(packet_size))
-                else:
-                    readdata, address = connection.recvfrom(4096)
-                    readdata = bytearray(readdata)
+            if not use_tcp:
+                # Drain the datagrams waiting on the socket a batch at a time, up to max_drain_batches per wakeup
+                drained_batches = 0
+                drained = 0
+                while True:
+                    if rx_index >= rx_count:
+                        if (not listener_ready) or (drained_batches >= max_drain_batches):
+                            break
+                        rx_index = 0
+                        rx_count = receiver.receive()
+                        drained_batches += 1
+                        drained += rx_count
+                        if rx_count == 0:
+                            break
+                        rx_time = time.monotonic()
+                        rx_timestamp = int(rx_time * 1e9)
+                        rx_times = None
+                        if receiver.timestamping:
+                            rx_times = receiver.times
+                        if receiver.gro:
+                            rx_magics, rx_versions, rx_lengths, rx_seqs = packetheader.unpack_headers_at(receiver.pool, receiver.offsets)
+                        else:
+                            rx_magics, rx_versions, rx_lengths, rx_seqs = packetheader.unpack_headers(receiver.pool, receiver.size, rx_count)
+                    
+                    # Counters are accumulated locally and added to the connection in one go for each run of
+                    # consecutive datagrams from the same remote host
+                    c = None
+                    c_address = None
+                    c_packets = 0
+                    c_bytes = 0
+                    while rx_index < rx_count:
+                        if rx_times:
+                            rx_timestamp = rx_times[rx_index]
+                            rx_time = rx_timestamp / 1e9
+                            # Leave the packets that arrived after the end of the period to be counted in the next
+                            if (sweep == False) and (rx_time >= start_time + period):
+                                break
+                        address = receiver.addresses[rx_index]
+                        length = receiver.lengths[rx_index]
+                        magic = rx_magics[rx_index]
+                        pktlen = rx_lengths[rx_index]
+                        seq = rx_seqs[rx_index]
+                        version = rx_versions[rx_index]
+                        rx_index += 1
+                        
+                        if address != c_address:
+                            if c:
+                                c.packets += c_packets
+                                c.bytes += c_bytes
+                                c.period_packets += c_packets
+                                c.period_bytes += c_bytes
+                                c_packets = 0
+                                c_bytes = 0
+                            c = flow_table.get(address)
+                            if c == None:
+                                c = add_connection(selector, None, address, rx_time, announce)
+                                if total_start_time == None:
+                                    total_start_time = time.monotonic()
+                            flow_table.update(c, rx_time)
+                            c_address = address
+                        
+                        # Answer a report request, including the packets counted so far in this run, without
+                        # counting it as data
+                        if (version == packetheader.report_request_version) and (length >= packetheader.header_size) and (magic == packetheader.magic_number):
+                            send_report(sock, address, seq, c.packets + c_packets)
+                            continue
+                        
+                        c_bytes += length
+                        if length < packetheader.header_size:
+                            continue
+                        
+                        if magic != packetheader.magic_number:
+                            print('{}: magic number mismatch {} != {}'.format(str(address[0])+":"+str(address[1]), magic, packetheader.magic_number))
+                            continue
+                        if pktlen != length:
+                            print('{}: length mismatch {} != {}'.format(str(address[0])+":"+str(address[1]), pktlen, length))
+                            continue
+                        
+                        if echo:
+                            try:
+                                offset = receiver.offsets[rx_index - 1]
+                                sock.sendto(receiver.pool_view[offset:offset + length], address)
+                            except OSError:
+                                pass
+                        
+                        c_packets += 1
+                        if record_sequence(c, seq, length, rx_time):
+                            c_packets = 0
+                            c_bytes = 0
+                        
+                        if (version >= packetheader.timestamp_version) and (length >= packetheader.timestamp_header_size):
+                            record_latency(c, rx_timestamp, packetheader.unpack_timestamp(receiver.pool, receiver.offsets[rx_index - 1]))
+                        
+                        last_rx_length = pktlen
+                        last_rx_time = this_rx_time
+                        this_rx_time = rx_time
+                        
+                        # A new size marks the next sweep step. Leave the rest of the batch until the step is reported
+                        if sweep and (controller == None) and (pktlen != sweep_rx_length):
+                            break
+                    
+                    if c:
+                        c.packets += c_packets
+                        c.bytes += c_bytes
+                        c.period_packets += c_packets
+                        c.period_bytes += c_bytes
+                    
+                    if rx_index < rx_count:
+                        break
                 
-                # Check if we have received from this remote host already. If not, add to list of connections
-                found = False
-                for c in connection_list:
-                    if c == address:
-                        found = True
+                if listener_ready:
+                    stats.record_wakeup(drained)
+                events = []
+            
+            if use_tcp and listener_ready:
+                # Accept all of the waiting connections. Each is registered with the selector once, with its address
+                while True:
+                    try:
+                        connection, client_address = sock.accept()
+                    except BlockingIOError:
                         break
-                if found == False:
-                    add_connection(None, address)
+                    add_connection(selector, connection, client_address, time.monotonic(), announce)
+                    selector.register(connection, selectors.EVENT_READ, client_address)
+
                     if total_start_time == None:
+                        if announce:
+                            start_time = time.monotonic()
                         total_start_time = time.monotonic()
 
-                if connection_list[address][11]:
-                    data = connection_list[address][11]
-                    connection_list[address][11] = None
-                    data.extend(readdata)
-                else:
-                    data = readdata
+            for key, mask in events:
+                if (key.fileobj is sock) or (key.fileobj is control_sock) or isinstance(key.data, control.ControlConnection):
+                    continue
                 
-                if len(data) > 0:
-                    connection_list[address][3] += len(readdata)
-                    connection_list[address][5] += len(readdata)
+                # Read as much as is waiting from one remote host
+                connection = key.fileobj
+                address = key.data
+                c = flow_table.get(address)
+                # The flow may have been dropped since select() returned, to make room for a new connection
+                if (c == None) or (c.connection is not connection):
+                    continue
+                stream = c.stream
+                try:
+                    length = stream.receive(connection)
+                except ConnectionError:
+                    length = 0
+                
+                if length > 0:
+                    rx_time = time.monotonic()
+                    rx_timestamp = int(rx_time * 1e9)
+                    flow_table.update(c, rx_time)
+                    c.bytes += length
+                    c.period_bytes += length
                     
-                    while len(data) >= 12:
-                        magic = (data[0] << 24) | (data[1] << 16) | (data[2] << 8) | data[3]
-                        pktlen = (data[4] << 24) | (data[5] << 16) | (data[6] << 8) | data[7]
+                    # Walk through the complete packets in the buffer, leaving any partial packet for the next read
+                    while stream.end - stream.start >= packetheader.header_size:
+                        magic, version, pktlen, seq = packetheader.unpack_header(stream.buffer, stream.start)
                         
-                        if magic != 0xBAADF00D:
-                            print('{}: magic number mismatch {} != {}'.format(str(address[0])+":"+str(address[1]), magic, 0xBAADF00D))
-                            data = None
-                        elif (pktlen != len(data)) and (use_tcp == False):
-                            print('{}: length mismatch {} != {}'.format(str(address[0])+":"+str(address[1]), pktlen, len(data)))
-                            data = None
+                        if magic != packetheader.magic_number:
+                            print('{}: magic number mismatch {} != {}'.format(str(address[0])+":"+str(address[1]), magic, packetheader.magic_number))
+                            stream.discard()
+                        elif (pktlen < packetheader.header_size) or (pktlen > len(stream.buffer)):
+                            print('{}: invalid length {}'.format(str(address[0])+":"+str(address[1]), pktlen))
+                            stream.discard()
+                        elif stream.end - stream.start < pktlen:
+                            break
                         else:
-                            if len(data) >= pktlen:
-                                connection_list[address][2] += 1
-                                connection_list[address][4] += 1
-                                seq = (data[8] << 24) | (data[9] << 16) | (data[10] << 8) | data[11]
-                                last_seq = connection_list[address][6]
-                                if last_seq == None:
-                                    last_seq = seq - 1
-                                elif (seq == 0) or (seq <= last_seq - 100):
-                                    print('{}: Reconnected'.format(str(address[0])+":"+str(address[1])))
-                                    connection_list[address] = [None, time.monotonic(), 0, 0, 0, 0, None, 0, 0, 0, 0, None]
-                                    last_seq = 0
-                                    
-                                if seq != last_seq + 1:
-                                    #print('{}: Lost {} packets (seq = {})'.format(str(address[0])+":"+str(address[1]), seq - last_seq - 1, seq))
-                                    connection_list[address][7] += seq - last_seq - 1
-                                    connection_list[address][8] += (seq - last_seq - 1) * len(data)
-                                    connection_list[address][9] += seq - last_seq - 1
-                                    connection_list[address][10] += (seq - last_seq - 1) * len(data)
-
-                                
-                                connection_list[address][6] = seq
-                                
-                                last_rx_length = pktlen
-                                last_rx_time = this_rx_time
-                                this_rx_time = time.monotonic()
-                                
-                                # Any data that is part of next packet, keep in a buffer
-                                if len(data) > pktlen:
-                                    data = data[pktlen:]
-                                else:
-                                    data = None
-                                    break
-                            else:
-                                break
-                    
-                    # Save any remaining data
-                    connection_list[address][11] = data
+                            c.packets += 1
+                            c.period_packets += 1
+                            record_sequence(c, seq, pktlen, rx_time)
+                            
+                            if (version >= packetheader.timestamp_version) and (pktlen >= packetheader.timestamp_header_size):
+                                record_latency(c, rx_timestamp, packetheader.unpack_timestamp(stream.buffer, stream.start))
+                            
+                            last_rx_length = pktlen
+                            last_rx_time = this_rx_time
+                            this_rx_time = rx_time
+                            
+                            stream.start += pktlen
                         
                 else:
                     print('{}: Client disconnected'.format(str(address[0])+":"+str(address[1])))
+                    selector.unregister(connection)
                     connection.close()
-                    del connection_list[address]
-                    if not connection_list:
-                        total_start_time = None
-                    
-            for connection in in_error:
-                ca = None
-                for c in connection_list:
-                    if connection_list[c][0] == connection:
-                        ca = c
-                        break
-                if ca and use_tcp:
-                    # Clean up the connection
-                    print('Client disconnected', ca)
-                    del connection_list[ca]
-                    connection.close()
-                    if not connection_list:
+                    flow_table.remove(address)
+                    if not flow_table:
                         total_start_time = None
+                    if announce:
+                        flows_removed()
 
+        except Exception:
+            # Interrupting the listener closes its socket, which ends the loop. Any other error is reported, and a
+            # shard exits with an error so that the coordinating process notices.
+            if exiting:
+                break
+            traceback.print_exc()
+            failed = True
+            break
         except:
             break
 
+    if failed:
+        sys.exit(1)
+
+# Run the listener in several shard processes, and merge the counters they report into one line per period
+def run_shards(server_address):
+    ctx = multiprocessing.get_context('fork')
+    report_queue = ctx.Queue()
+    start_event = ctx.Event()
+    processes = []
+    for x in range(shards):
+        processes.append(ctx.Process(target=run_profiled, args=(x, run_listener, server_address, x, report_queue, start_event)))
+        processes[-1].start()
+    start_event.set()
+    # The threads are started after the shards, so that the shard processes don't inherit them
+    start_export()
+
+    # Each flow is owned by one shard. Columns are kept in the order the flows were first seen. A period is only
+    # reported once every shard has reported it, so if a shard fails the listener stops, rather than going quiet.
+    addresses = []
+    reports = {}
+    failed = []
+    while True:
+        try:
+            report = report_queue.get(timeout=0.1)
+        except queue.Empty:
+            failed = failed_processes(processes)
+            if failed:
+                print('Shard {} stopped unexpectedly, stopping the listener'.format(failed[0] + 1))
+                break
+            if exiting or not any(p.is_alive() for p in processes):
+                break
+            continue
+        report_number = report[1]
+        reports.setdefault(report_number, []).append(report)
+        if len(reports[report_number]) < shards:
+            continue
+
+        flows = {}
+        r = reports.pop(report_number)
+        for x in r:
+            for f in x[2]:
+                flows[f[0]] = f
+        listener_stats = None
+        if self_stats:
+            listener_stats = selfstats.combine_listener([x[3] for x in r])
+        
+        removed = [c for c in addresses if c not in flows]
+        addresses = [c for c in addresses if c in flows]
+        new_addresses = [c for c in flows if c not in addresses]
+        for c in new_addresses:
+            announce_connection(c)
+            addresses.append(c)
+        if removed:
+            flows_removed()
+        print_connection_changes(addresses)
+        
+        if addresses:
+            print_period([flows[c] for c in addresses], listener_stats)
+        else:
+            print('Waiting for connection...')
+            if listener_stats:
+                print(selfstats.format_listener(listener_stats, 0))
+            export_period([], [], 0)
+        
+        if listen_once:
+            break
+
+    for p in processes:
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGINT)
+        p.join()
+    if failed:
+        stop_export()
+        sys.exit(1)
+
+if (listen == False) and traffic_file:
+    print('Sending traffic profile {}'.format(traffic_file))
+    if mtu != 1500:
+        print('MTU = {}'.format(mtu))
+    run_profiled(None, run_traffic)
+elif listen == False:
+    print('Period =', period)
+    print('Connecting to %s port %s' % (address, listen_port_number))
+    if sweep:
+        print('Sweeping payload size from {} bytes to {} bytes (plus ethernet overhead of {} bytes'.format(sweep_step_sizes[0], sweep_step_sizes[-1], packet_overhead(sweep_step_sizes[0])) )
+    print('Ethernet bitrate = {:.0f} bps'.format(bitrate))
+    if mtu != 1500:
+        print('MTU = {}'.format(mtu))
+    if find_max:
+        print('Searching for the maximum rate with up to {}% loss, {:g}s per trial'.format(max_loss, period))
+    if bulk:
+        run_profiled(None, run_bulk_sender, bitrate)
+    elif workers > 1:
+        print('Sending from {} workers'.format(workers))
+        run_workers()
+    else:
+        run_profiled(None, run_sender, packet_size, bitrate)
+else:
+    server_address = (address, listen_port_number)
+    print('Listening on %s port %s' % server_address)
+    if sweep:
+        print('Average period = {:.1f}'.format(period))
+    if shards > 1:
+        print('Listening with {} shards'.format(shards))
+    print('')
+    if shards > 1:
+        run_shards(server_address)
+        stop_export()
+    else:
+        # The results waiting to be exported are written even if the listener fails
+        start_export()
+        try:
+            run_profiled(None, run_listener, server_address)
+        finally:
+            stop_export()
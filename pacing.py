@@ -0,0 +1,202 @@
+# Network Tester packet pacing
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# A pacer is told the interval between packets with start(), and pace() is called after each send. pace() records
+# the departure and waits until the next send is due. The strategies available are:
+#
+#   schedule  sleep until the time that the packets sent so far should have taken (the original behaviour)
+#   spin      the same schedule, but sleeps coarsely and busy waits the last part of each gap
+#   bucket    token bucket, allowing up to bucket_size packets back to back to catch up after a late send.
+#             The default size is default_bucket_time's worth of packets, enough to make up for sleep() overshoot
+#   timerfd   token bucket driven by a periodic kernel timer (Linux only)
+
+import ctypes
+import ctypes.util
+import math
+import os
+import struct
+import time
+
+pacer_names = ['schedule', 'spin', 'bucket', 'timerfd']
+
+spin_threshold = 0.0002 # Gaps shorter than this are busy waited rather than slept
+min_timer_period = 0.00005 # Shortest period used for timerfd, several packets are released per tick below this
+default_bucket_time = 0.001 # Without a bucket size, the bucket holds this long's worth of packets
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", timespec), ("it_value", timespec)]
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc_timerfd_create = libc.timerfd_create
+    libc_timerfd_create.argtypes = [ctypes.c_int, ctypes.c_int]
+    libc_timerfd_create.restype = ctypes.c_int
+    libc_timerfd_settime = libc.timerfd_settime
+    libc_timerfd_settime.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(itimerspec), ctypes.c_void_p]
+    libc_timerfd_settime.restype = ctypes.c_int
+    timerfd_available = hasattr(time, 'CLOCK_MONOTONIC')
+except (OSError, AttributeError, TypeError):
+    timerfd_available = False
+
+class DepartureStats:
+    # Statistics of the gaps between departures. Only running sums are kept, so recording is O(1), and the
+    # summaries from several senders can be combined.
+    def __init__(self):
+        self.last = None
+        self.target = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, now):
+        if self.last != None:
+            gap = now - self.last
+            self.count += 1
+            self.total += gap
+            self.total_sq += gap * gap
+            if (self.min == None) or (gap < self.min):
+                self.min = gap
+            if gap > self.max:
+                self.max = gap
+        self.last = now
+
+    # Returns (count, total, total of squares, min, max, target gap) for the gaps since the last reset
+    def summary(self):
+        return (self.count, self.total, self.total_sq, self.min, self.max, self.target)
+
+# Combine the summaries from several senders into one
+def combine_summaries(summaries):
+    mins = [s[3] for s in summaries if s[3] != None]
+    return (sum(s[0] for s in summaries), sum(s[1] for s in summaries), sum(s[2] for s in summaries),
+            min(mins) if mins else None, max(s[4] for s in summaries), max(s[5] for s in summaries))
+
+def format_summary(summary):
+    count, total, total_sq, gap_min, gap_max, target = summary
+    if count == 0:
+        return 'Departure gap: no departures'
+    mean = total / count
+    stdev = math.sqrt(max(total_sq / count - mean * mean, 0))
+    return 'Departure gap: target {:.1f}us mean {:.1f}us stdev {:.1f}us min {:.1f}us max {:.1f}us ({} gaps)'.format(
+        target * 1e6, mean * 1e6, stdev * 1e6, gap_min * 1e6, gap_max * 1e6, count)
+
+class SchedulePacer:
+    # Sleeps until the time that the packets sent so far should have taken at the requested rate, correcting for
+    # loop overhead and an imprecise delay function
+    def __init__(self, delay):
+        self.delay = delay
+        self.stats = DepartureStats()
+
+    def start(self, interval, packets):
+        self.interval = interval
+        self.stats.target = interval * packets
+        self.start_time = time.monotonic()
+        self.packets_sent = 0
+
+    def pace(self, packets):
+        now = time.monotonic()
+        self.stats.record(now)
+        self.packets_sent += packets
+        wait_time = self.start_time + self.packets_sent * self.interval - now
+        if wait_time > 0:
+            self.wait(now + wait_time, wait_time)
+
+    def wait(self, deadline, wait_time):
+        self.delay(wait_time)
+
+class SpinPacer(SchedulePacer):
+    # Follows the same schedule, but sleep() can't be relied on for short gaps, so the last spin_threshold of each
+    # gap is busy waited
+    def wait(self, deadline, wait_time):
+        if wait_time > spin_threshold:
+            self.delay(wait_time - spin_threshold)
+        while time.monotonic() < deadline:
+            pass
+
+class BucketPacer:
+    # Token bucket. Tokens accumulate at the packet rate up to bucket_size, and each packet sent takes one. After a
+    # late send, up to bucket_size packets can go back to back to catch up, but never more.
+    def __init__(self, delay, bucket_size=None):
+        self.delay = delay
+        self.bucket_size = bucket_size
+        self.stats = DepartureStats()
+
+    def start(self, interval, packets):
+        self.interval = interval
+        self.stats.target = interval * packets
+        if self.bucket_size:
+            self.size = max(self.bucket_size, packets)
+        elif interval > 0:
+            self.size = max(int(default_bucket_time / interval), packets)
+        else:
+            self.size = packets
+        self.tokens = self.size
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        if self.interval > 0:
+            self.tokens = min(self.tokens + (now - self.last) / self.interval, self.size)
+        else:
+            self.tokens = self.size
+        self.last = now
+
+    def pace(self, packets):
+        now = time.monotonic()
+        self.stats.record(now)
+        self.refill(now)
+        self.tokens -= packets
+        # Wait until there are enough tokens to send the same number again
+        if self.tokens < packets:
+            self.delay((packets - self.tokens) * self.interval)
+
+class TimerfdPacer(BucketPacer):
+    # Token bucket where the tokens come from the expirations of a periodic timerfd, so the thread sleeps in
+    # the kernel until the next tick instead of in time.sleep()
+    def __init__(self, delay, bucket_size=None):
+        BucketPacer.__init__(self, delay, bucket_size)
+        self.fd = libc_timerfd_create(time.CLOCK_MONOTONIC, 0)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def start(self, interval, packets):
+        BucketPacer.start(self, interval, packets)
+        self.tokens = packets
+        # Release several packets per tick, rather than asking for a timer period the kernel can't keep up with
+        self.packets_per_tick = max(int(math.ceil(min_timer_period / interval)), 1) if interval > 0 else self.size
+        period = max(interval * self.packets_per_tick, 1e-9)
+        spec = itimerspec()
+        spec.it_interval.tv_sec = int(period)
+        spec.it_interval.tv_nsec = int((period - int(period)) * 1e9)
+        spec.it_value = spec.it_interval
+        if libc_timerfd_settime(self.fd, 0, ctypes.byref(spec), None) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def pace(self, packets):
+        self.stats.record(time.monotonic())
+        self.tokens -= packets
+        while self.tokens < packets:
+            expirations = struct.unpack('=Q', os.read(self.fd, 8))[0]
+            self.tokens = min(self.tokens + expirations * self.packets_per_tick, self.size)
+
+def create_pacer(name, delay, bucket_size=None):
+    if name == 'spin':
+        return SpinPacer(delay)
+    elif name == 'bucket':
+        return BucketPacer(delay, bucket_size)
+    elif name == 'timerfd':
+        return TimerfdPacer(delay, bucket_size)
+    return SchedulePacer(delay)
@@ -0,0 +1,120 @@
+# Network Tester packet header codec
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Every packet starts with a 12 byte header, all fields big endian:
+#
+#   bytes 0-3   magic number 0xBAADF00D
+#   byte  4     header version
+#   bytes 5-7   packet length, including the header
+#   bytes 8-11  sequence number
+#
+# Version 0 is the original header, where bytes 4-7 were a 32 bit length. Packets are never large enough to use
+# the top byte of the length, so version 0 packets are the same as those sent by older versions of the tester.
+# Later versions add fields after the sequence number:
+#
+#   version 1   bytes 12-19  transmit timestamp, nanoseconds on the sender's monotonic clock
+#
+# Versions from 0x80 up are control packets between the sender and the listener, which are not counted as data:
+#
+#   0x80        report request, just the header. The sequence number identifies the request
+#   0x81        report, the answer to a request, with the same sequence number
+#               bytes 12-19  number of packets the listener has received on the flow
+
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+magic_number = 0xBAADF00D
+header_version = 0
+header_size = 12
+timestamp_version = 1
+timestamp_header_size = 20
+max_packet_length = 0xFFFFFF
+report_request_version = 0x80
+report_version = 0x81
+report_size = 20
+
+header_struct = struct.Struct('>III')
+sequence_struct = struct.Struct('>I')
+timestamp_struct = struct.Struct('>Q')
+report_struct = struct.Struct('>Q')
+
+# Write a complete header at the start of buf
+def pack_header(buf, length, sequence_number, version=header_version):
+    header_struct.pack_into(buf, 0, magic_number, (version << 24) | length, sequence_number & 0xFFFFFFFF)
+
+# Rewrite just the sequence number of a packet that already has a header
+def pack_sequence(buf, sequence_number):
+    sequence_struct.pack_into(buf, 8, sequence_number & 0xFFFFFFFF)
+
+# Write the transmit timestamp of a version 1 header
+def pack_timestamp(buf, timestamp):
+    timestamp_struct.pack_into(buf, 12, timestamp)
+
+# Read the transmit timestamp of a version 1 header at offset in buf
+def unpack_timestamp(buf, offset=0):
+    return timestamp_struct.unpack_from(buf, offset + 12)[0]
+
+# Current time on the monotonic clock used for timestamps, in nanoseconds
+def timestamp_now():
+    return int(time.monotonic() * 1e9)
+
+# Write the packet count of a report
+def pack_report(buf, packets):
+    report_struct.pack_into(buf, 12, packets)
+
+# Read the packet count of a report
+def unpack_report(buf):
+    return report_struct.unpack_from(buf, 12)[0]
+
+# Read the header at offset in buf. Returns (magic, version, length, sequence number).
+def unpack_header(buf, offset=0):
+    magic, word, seq = header_struct.unpack_from(buf, offset)
+    return magic, word >> 24, word & max_packet_length, seq
+
+# Read the headers of count packets stored stride bytes apart in buf, as received into a pool of buffers.
+# Returns lists of the magic numbers, versions, lengths and sequence numbers. With NumPy the headers are all
+# decoded in one pass over a view of buf, without copying the packets.
+def unpack_headers(buf, stride, count):
+    if count == 0:
+        return [], [], [], []
+    if numpy and (stride % 4 == 0):
+        words = numpy.frombuffer(buf, dtype='>u4', count=count * stride // 4).reshape(count, stride // 4)
+        return words[:, 0].tolist(), (words[:, 1] >> 24).tolist(), (words[:, 1] & max_packet_length).tolist(), words[:, 2].tolist()
+
+    magics = [0] * count
+    versions = [0] * count
+    lengths = [0] * count
+    seqs = [0] * count
+    unpack_from = header_struct.unpack_from
+    for x in range(count):
+        magic, word, seqs[x] = unpack_from(buf, x * stride)
+        magics[x] = magic
+        versions[x] = word >> 24
+        lengths[x] = word & max_packet_length
+    return magics, versions, lengths, seqs
+
+# Read the headers of the packets at each of offsets in buf, which need not be evenly spaced, such as datagrams
+# split out of a message coalesced by GRO. Returns lists as unpack_headers().
+def unpack_headers_at(buf, offsets):
+    count = len(offsets)
+    magics = [0] * count
+    versions = [0] * count
+    lengths = [0] * count
+    seqs = [0] * count
+    unpack_from = header_struct.unpack_from
+    for x in range(count):
+        magic, word, seqs[x] = unpack_from(buf, offsets[x])
+        magics[x] = magic
+        versions[x] = word >> 24
+        lengths[x] = word & max_packet_length
+    return magics, versions, lengths, seqs
@@ -0,0 +1,56 @@
+# Network Tester packet payloads
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# The payload of each packet follows one of these patterns, which matters on links that compress:
+#
+#   random     random bytes from os.urandom, which can't be compressed (the default)
+#   zeros      all zero bytes
+#   repeating  the bytes 0 to 255 repeated
+#   file       the contents of a file, repeated to fill the packet
+#
+# A packet is built once for each size and cached, so changing size is just a lookup. The header is written over
+# the start of the payload by the sender.
+
+import os
+
+payload_names = ['random', 'zeros', 'repeating', 'file']
+
+max_file_size = 65536 # Only the start of a larger file is used, which is enough for any packet
+
+class PayloadCache:
+    def __init__(self, pattern='random', path=None):
+        self.pattern = pattern
+        self.packets = {}
+        self.data = None
+        if pattern == 'file':
+            with open(path, 'rb') as f:
+                self.data = f.read(max_file_size)
+            if not self.data:
+                raise ValueError('payload file {} is empty'.format(path))
+        elif pattern == 'repeating':
+            self.data = bytes(range(256))
+
+    def build(self, size):
+        if self.pattern == 'random':
+            return bytearray(os.urandom(size))
+        elif self.pattern == 'zeros':
+            return bytearray(size)
+        return bytearray((self.data * (size // len(self.data) + 1))[:size])
+
+    # The packet buffer for a size, built the first time it is asked for
+    def get(self, size):
+        packet = self.packets.get(size)
+        if packet == None:
+            packet = self.build(size)
+            self.packets[size] = packet
+        return packet
+
+    # Build the packets for all of the sizes that will be sent, before sending starts
+    def prepare(self, sizes):
+        for size in sizes:
+            self.get(size)
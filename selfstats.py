@@ -0,0 +1,118 @@
+# Network Tester self-instrumentation
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# With --stats the sender and the listener measure where their own time goes, so that a result limited by the
+# tester can be told apart from one limited by the link.
+#
+# The sender splits each period into the time spent in the socket send calls, the time spent waiting in the pacer,
+# and everything else, which is the Python loop overhead. It also counts the sends the socket refused because its
+# buffer was full (EWOULDBLOCK) or the kernel was out of buffers (ENOBUFS), and how far it has fallen behind the
+# rate's schedule. A sender that spends little time waiting in the pacer is running flat out.
+#
+# The listener measures the time it is busy rather than waiting in select(), the number of datagrams drained on
+# each wakeup, and the datagrams the kernel dropped because the socket's receive buffer was full. Drops are read
+# from /proc/net/udp (Linux), which keeps a count for each socket. Loss at the listener with no kernel drops
+# happened before the packets reached the host.
+# It also counts the flows that were added to its flow table, and those dropped from it for being idle or to make
+# room for new ones, so that a table too small for the number of senders shows up.
+#
+# The counters only cover the period since the last reset, and are summarised as tuples so that the summaries
+# from several workers or shards can be combined.
+
+import os
+import time
+
+class SenderStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.send_time = 0.0
+        self.send_calls = 0
+        self.pace_time = 0.0
+        self.would_block = 0
+        self.no_buffers = 0
+
+    # Returns (duration, send time, send calls, pacing time, would block count, no buffers count, schedule lag)
+    # for the period since the last reset. lag is how far the sender is behind the rate's schedule, in seconds.
+    def summary(self, lag):
+        return (time.perf_counter() - self.start_time, self.send_time, self.send_calls, self.pace_time,
+                self.would_block, self.no_buffers, lag)
+
+# Combine the summaries from several workers. Times are summed, so that the shares are of the workers' total time.
+def combine_sender(summaries):
+    return (sum(s[0] for s in summaries), sum(s[1] for s in summaries), sum(s[2] for s in summaries),
+            sum(s[3] for s in summaries), sum(s[4] for s in summaries), sum(s[5] for s in summaries),
+            max(s[6] for s in summaries))
+
+def format_sender(summary):
+    duration, send_time, send_calls, pace_time, would_block, no_buffers, lag = summary
+    duration = max(duration, 1e-9)
+    return 'Sender time: sending {:.1f}% ({:.1f}us per call), pacing {:.1f}%, other {:.1f}%, behind schedule {:.1f}ms, would block {}, no buffers {}'.format(
+        send_time * 100.0 / duration, send_time * 1e6 / max(send_calls, 1), pace_time * 100.0 / duration,
+        max(duration - send_time - pace_time, 0) * 100.0 / duration, lag * 1000.0, would_block, no_buffers)
+
+class ListenerStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.idle_time = 0.0
+        self.wakeups = 0
+        self.drained = 0
+        self.max_drained = 0
+
+    # Note the number of datagrams drained on one wakeup of the listener
+    def record_wakeup(self, datagrams):
+        self.wakeups += 1
+        self.drained += datagrams
+        if datagrams > self.max_drained:
+            self.max_drained = datagrams
+
+    # Returns (duration, busy time, wakeups, datagrams drained, most drained on one wakeup, kernel drops or None,
+    # flows added, flows timed out, flows evicted) for the period since the last reset. flow_counts is the number
+    # of flows added, timed out and evicted in the period.
+    def summary(self, drops, flow_counts):
+        duration = time.perf_counter() - self.start_time
+        return (duration, max(duration - self.idle_time, 0), self.wakeups, self.drained, self.max_drained, drops) + tuple(flow_counts)
+
+# Combine the summaries from several shards
+def combine_listener(summaries):
+    drops = [s[5] for s in summaries if s[5] != None]
+    return (sum(s[0] for s in summaries), sum(s[1] for s in summaries), sum(s[2] for s in summaries),
+            sum(s[3] for s in summaries), max(s[4] for s in summaries), sum(drops) if drops else None,
+            sum(s[6] for s in summaries), sum(s[7] for s in summaries), sum(s[8] for s in summaries))
+
+# Format a listener summary, with the number of packets received in the period to give the time per packet
+def format_listener(summary, packets):
+    duration, busy_time, wakeups, drained, max_drained, drops, added, timed_out, evicted = summary
+    s = 'Listener time: busy {:.1f}%'.format(busy_time * 100.0 / max(duration, 1e-9))
+    if packets:
+        s += ' ({:.1f}us per packet)'.format(busy_time * 1e6 / packets)
+    if wakeups:
+        s += ', {:.1f} datagrams per wakeup (max {})'.format(drained / wakeups, max_drained)
+    if drops != None:
+        s += ', kernel drops {}'.format(drops)
+    s += ', new flows {}, timed out {}, dropped for room {}'.format(added, timed_out, evicted)
+    return s
+
+# The number of datagrams the kernel has dropped for a UDP socket since it was opened, from /proc/net/udp.
+# Returns None if it isn't available.
+def read_udp_drops(sock):
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open('/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                if (len(fields) >= 13) and (fields[9] == inode):
+                    return int(fields[12])
+    except (OSError, ValueError):
+        pass
+    return None
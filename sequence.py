@@ -0,0 +1,76 @@
+# Network Tester sequence number tracking
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Each flow keeps the highest sequence number received, and a bitmap of which of the window_size sequence numbers
+# up to it have been received. Sequence numbers are compared modulo 2^32, so a flow carries on across wraparound.
+# A packet is classified as:
+#
+#   in order   newer than any before it. Any sequence numbers skipped over are counted as lost straight away
+#   late       older than the highest, filling a gap in the window. It was counted as lost, and no longer is
+#   duplicate  a sequence number already received
+#   restart    further behind than the window, so the sender must have started again, or back to the first
+#              sequence number before the flow has ever wrapped around
+#
+# Recording a packet is O(1), apart from shifting the bitmap, and the memory used is fixed.
+
+window_size = 1024
+
+sequence_mask = 0xFFFFFFFF
+first_sequence = 1
+
+late = -1
+duplicate = -2
+restart = -3
+
+class SequenceTracker:
+    def __init__(self):
+        self.window_mask = (1 << window_size) - 1
+        self.highest = None
+        self.received = 0
+        self.cycles = 0
+
+    # Record a packet's sequence number. Returns how many packets were skipped over before it if it is in order,
+    # otherwise late, duplicate or restart. After a restart the packet is the first of a new sequence.
+    def record(self, seq):
+        if self.highest == None:
+            self.start(seq)
+            return 0
+
+        delta = (seq - self.highest) & sequence_mask
+        if delta == 1:
+            if seq == 0:
+                self.cycles += 1
+            self.highest = seq
+            self.received = ((self.received << 1) | 1) & self.window_mask
+            return 0
+
+        if (delta != 0) and (delta < 0x80000000) and ((seq != first_sequence) or self.cycles):
+            if seq < self.highest:
+                self.cycles += 1
+            self.highest = seq
+            if delta >= window_size:
+                self.received = 1
+            else:
+                self.received = ((self.received << delta) | 1) & self.window_mask
+            return delta - 1
+
+        age = (self.highest - seq) & sequence_mask
+        if (age >= window_size) or ((seq == first_sequence) and not(self.cycles)):
+            self.start(seq)
+            return restart
+        bit = 1 << age
+        if self.received & bit:
+            return duplicate
+        self.received |= bit
+        return late
+
+    # Start a new sequence at seq. Anything before it is treated as already received.
+    def start(self, seq):
+        self.highest = seq
+        self.cycles = 0
+        self.received = self.window_mask
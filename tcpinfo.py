@@ -0,0 +1,61 @@
+# Network Tester TCP connection statistics
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# On Linux the kernel keeps statistics for each TCP connection, which are read with the TCP_INFO socket option as
+# a struct tcp_info. The struct has grown over the years, but only fields from its original 104 bytes are used, so
+# the offsets are the same on every kernel:
+#
+#   snd_mss        bytes in each segment sent
+#   lost           segments currently thought to be lost
+#   rtt, rttvar    smoothed round trip time and its variation, microseconds
+#   snd_ssthresh   slow start threshold, segments
+#   snd_cwnd       congestion window, segments
+#   total_retrans  segments retransmitted over the life of the connection
+#
+# Elsewhere read() returns None, and the statistics are left out.
+
+import socket
+import struct
+import sys
+
+if hasattr(socket, 'TCP_INFO'):
+    TCP_INFO = socket.TCP_INFO
+elif sys.platform.startswith('linux'):
+    TCP_INFO = 11
+else:
+    TCP_INFO = None
+
+tcp_info_size = 104
+
+field_offsets = {
+    'snd_mss': 16,
+    'lost': 32,
+    'rtt': 68,
+    'rttvar': 72,
+    'snd_ssthresh': 76,
+    'snd_cwnd': 80,
+    'total_retrans': 100,
+}
+
+field_struct = struct.Struct('=I')
+
+# Read the statistics of a connected TCP socket. Returns a dict of the fields above, or None if they aren't available.
+def read(sock):
+    if TCP_INFO == None:
+        return None
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, tcp_info_size)
+    except OSError:
+        return None
+    if len(data) < tcp_info_size:
+        return None
+    return dict((name, field_struct.unpack_from(data, offset)[0]) for name, offset in field_offsets.items())
+
+# Format the statistics for a report, with the number of segments retransmitted since the last one
+def format_info(info, retransmits):
+    return 'rtt {:.2f}ms, cwnd {} segments, retransmits {}'.format(info['rtt'] / 1000.0, info['snd_cwnd'], retransmits)
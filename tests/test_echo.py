@@ -0,0 +1,64 @@
+# Network Tester round trip time tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Runs an echo listener and two senders at different rates over loopback. The senders read their echoes between
+# sends, so this checks that the round trip time they report is the time on the network, not the gap between
+# packets. Takes about 15 seconds.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import unittest
+
+tester = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'networktester.py')
+port = 20170
+report_time = 12.0 # The sender reports every 10 seconds
+
+def start(args):
+    return subprocess.Popen([sys.executable, tester, '--port', str(port)] + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    return process.communicate(timeout=10)[0]
+
+# The p50 round trip time in microseconds from a sender's output, or None
+def round_trip_p50(text):
+    m = re.search(r'Round trip p50 ([\d.]+)(us|ms)', text)
+    if not m:
+        return None
+    return float(m.group(1)) * (1000.0 if m.group(2) == 'ms' else 1.0)
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'echoes are timed by the kernel on Linux')
+class EchoTest(unittest.TestCase):
+    def test_round_trip_does_not_depend_on_rate(self):
+        listener = start(['--listen', '--echo'])
+        try:
+            time.sleep(0.5)
+            slow = start(['--address', '127.0.0.1', '--size', '100', '--rate', '300000', '--echo'])
+            fast = start(['--address', '127.0.0.1', '--size', '100', '--rate', '3000000', '--echo'])
+            time.sleep(report_time)
+            slow_text = stop(slow)
+            fast_text = stop(fast)
+        finally:
+            stop(listener)
+
+        slow_rtt = round_trip_p50(slow_text)
+        fast_rtt = round_trip_p50(fast_text)
+        self.assertIsNotNone(slow_rtt, slow_text)
+        self.assertIsNotNone(fast_rtt, fast_text)
+        # The gap between packets is about 3.5ms at the slow rate and 350us at the fast one
+        self.assertLess(abs(slow_rtt - fast_rtt), 300.0, (slow_rtt, fast_rtt))
+
+if __name__ == '__main__':
+    unittest.main()
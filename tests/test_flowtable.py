@@ -0,0 +1,67 @@
+# Network Tester flow table tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import flowtable
+
+def address(n):
+    return ('10.0.0.1', 20000 + n)
+
+class FlowTableTest(unittest.TestCase):
+    def test_evicts_least_recently_active(self):
+        table = flowtable.FlowTable(max_flows=3)
+        for n in range(3):
+            table.add(address(n), None, None, n)
+        self.assertTrue(table.full())
+        table.update(table.get(address(0)), 10)
+        self.assertEqual(table.pop_oldest().address, address(1))
+        self.assertEqual(table.pop_oldest().address, address(2))
+        self.assertEqual(table.pop_oldest().address, address(0))
+        self.assertEqual(table.counts(), (3, 0, 3))
+
+    def test_addresses_in_order_first_seen(self):
+        table = flowtable.FlowTable()
+        for n in range(3):
+            table.add(address(n), None, None, n)
+        table.update(table.get(address(0)), 10)
+        self.assertEqual(table.addresses(), [address(0), address(1), address(2)])
+
+    def test_expire_idle_flows(self):
+        table = flowtable.FlowTable(idle_timeout=5.0)
+        for n in range(3):
+            table.add(address(n), None, None, n)
+        table.update(table.get(address(0)), 4)
+        self.assertEqual([f.address for f in table.expire(7.5)], [address(1), address(2)])
+        self.assertEqual(table.addresses(), [address(0)])
+        self.assertEqual(table.counts(), (3, 2, 0))
+
+    def test_no_timeout(self):
+        table = flowtable.FlowTable(idle_timeout=0)
+        table.add(address(0), None, None, 0)
+        self.assertEqual(table.expire(1e9), [])
+        self.assertEqual(len(table), 1)
+
+    def test_new_period_zeroes_counters(self):
+        table = flowtable.FlowTable()
+        flow = table.add(address(0), None, None, 0)
+        flow.period_packets = 5
+        table.new_period()
+        self.assertEqual([f.period_packets for f in table.period_flows()], [0])
+        table.update(flow, 1)
+        flow.period_packets += 1
+        self.assertEqual(flow.period_packets, 1)
+
+if __name__ == '__main__':
+    unittest.main()
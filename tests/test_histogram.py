@@ -0,0 +1,75 @@
+# Network Tester latency histogram tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import histogram
+
+# Largest relative error of a recorded value
+max_error = 2.0 ** -(histogram.sub_bucket_bits - 1)
+
+def record_all(hist, values):
+    for value in values:
+        hist.record(value)
+    return hist
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(histogram.LatencyHistogram().percentile(50), 0)
+
+    def test_small_values_are_exact(self):
+        hist = record_all(histogram.LatencyHistogram(), range(1, 101))
+        self.assertEqual(hist.percentile(50), 50)
+        self.assertEqual(hist.percentile(99), 99)
+        self.assertEqual(hist.percentile(100), 100)
+
+    def test_percentile_accuracy(self):
+        values = [1000 + x * 997 for x in range(10000)]
+        hist = record_all(histogram.LatencyHistogram(), values)
+        for percent in [1, 50, 90, 99, 99.9]:
+            exact = values[int(len(values) * percent / 100.0 + 0.5) - 1]
+            self.assertLessEqual(abs(hist.percentile(percent) - exact), exact * max_error, percent)
+        self.assertEqual(hist.percentile(100), values[-1])
+        self.assertEqual(hist.max, values[-1])
+
+    def test_every_value_in_its_bucket(self):
+        hist = histogram.LatencyHistogram()
+        for value in [0, 127, 128, 129, 255, 256, 1000, 123456, 987654321]:
+            top = hist.value_at(hist.index(value))
+            self.assertGreaterEqual(top, value)
+            self.assertLessEqual(top - value, value * max_error)
+
+    def test_out_of_range_values_are_clamped(self):
+        hist = record_all(histogram.LatencyHistogram(), [-5, 1 << 50])
+        self.assertEqual(hist.percentile(50), 0)
+        self.assertEqual(hist.max, hist.max_value)
+
+    def test_merge(self):
+        low = record_all(histogram.LatencyHistogram(), range(1, 51))
+        high = record_all(histogram.LatencyHistogram(), range(51, 101))
+        low.merge(high)
+        self.assertEqual(low.count, 100)
+        self.assertEqual(low.max, 100)
+        self.assertEqual(low.percentile(50), 50)
+        self.assertEqual(low.percentile(75), 75)
+
+    def test_pickle(self):
+        hist = record_all(histogram.LatencyHistogram(), [10, 2000, 3000000])
+        copy = pickle.loads(pickle.dumps(hist))
+        self.assertEqual(copy.counts, hist.counts)
+        self.assertEqual((copy.count, copy.max), (hist.count, hist.max))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# Network Tester packet header tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import packetheader
+
+class PacketHeaderTest(unittest.TestCase):
+    def test_round_trip(self):
+        buf = bytearray(100)
+        packetheader.pack_header(buf, 100, 12345)
+        self.assertEqual(packetheader.unpack_header(buf),
+                         (packetheader.magic_number, packetheader.header_version, 100, 12345))
+
+    def test_version_0_matches_older_testers(self):
+        # Older testers wrote a 32 bit length where the version and length now are
+        buf = bytearray(packetheader.header_size)
+        packetheader.pack_header(buf, 1000, 7)
+        self.assertEqual(bytes(buf), bytes.fromhex('BAADF00D000003E800000007'))
+
+    def test_sequence_wraps(self):
+        buf = bytearray(packetheader.header_size)
+        packetheader.pack_header(buf, packetheader.header_size, 0x100000002)
+        self.assertEqual(packetheader.unpack_header(buf)[3], 2)
+        packetheader.pack_sequence(buf, 0xFFFFFFFF + 5)
+        self.assertEqual(packetheader.unpack_header(buf)[3], 4)
+
+    def test_largest_length(self):
+        buf = bytearray(packetheader.header_size)
+        packetheader.pack_header(buf, packetheader.max_packet_length, 1, packetheader.timestamp_version)
+        self.assertEqual(packetheader.unpack_header(buf)[1:3], (packetheader.timestamp_version, packetheader.max_packet_length))
+
+    def test_timestamp(self):
+        buf = bytearray(packetheader.timestamp_header_size + 8)
+        now = packetheader.timestamp_now()
+        packetheader.pack_header(buf, len(buf), 3, packetheader.timestamp_version)
+        packetheader.pack_timestamp(buf, now)
+        self.assertEqual(packetheader.unpack_header(buf), (packetheader.magic_number, packetheader.timestamp_version, len(buf), 3))
+        self.assertEqual(packetheader.unpack_timestamp(buf), now)
+
+    def test_report_request_and_report(self):
+        request = bytearray(packetheader.header_size)
+        packetheader.pack_header(request, len(request), 9, packetheader.report_request_version)
+        self.assertEqual(packetheader.unpack_header(request), (packetheader.magic_number, 0x80, len(request), 9))
+
+        report = bytearray(packetheader.report_size)
+        packetheader.pack_header(report, len(report), 9, packetheader.report_version)
+        packetheader.pack_report(report, 1 << 40)
+        self.assertEqual(packetheader.unpack_header(report), (packetheader.magic_number, 0x81, len(report), 9))
+        self.assertEqual(packetheader.unpack_report(report), 1 << 40)
+
+    def test_unpack_headers(self):
+        stride = 64
+        buf = bytearray(stride * 3)
+        for x in range(3):
+            packetheader.pack_header(memoryview(buf)[x * stride:], 40 + x, 100 + x, x % 2)
+        expected = ([packetheader.magic_number] * 3, [0, 1, 0], [40, 41, 42], [100, 101, 102])
+        self.assertEqual(packetheader.unpack_headers(buf, stride, 3), expected)
+        self.assertEqual(packetheader.unpack_headers_at(buf, [0, stride, 2 * stride]), expected)
+        self.assertEqual(packetheader.unpack_headers(buf, stride, 0), ([], [], [], []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# Network Tester sequence number tracking tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sequence
+
+def record_all(tracker, numbers):
+    return [tracker.record(seq) for seq in numbers]
+
+class SequenceTrackerTest(unittest.TestCase):
+    def test_in_order(self):
+        self.assertEqual(record_all(sequence.SequenceTracker(), [1, 2, 3, 4]), [0, 0, 0, 0])
+
+    def test_gap_is_lost(self):
+        self.assertEqual(record_all(sequence.SequenceTracker(), [1, 2, 5]), [0, 0, 2])
+
+    def test_reorder(self):
+        # 3 is counted as lost when 4 arrives, then as late when it does
+        self.assertEqual(record_all(sequence.SequenceTracker(), [1, 2, 4, 3]), [0, 0, 1, sequence.late])
+
+    def test_duplicate(self):
+        self.assertEqual(record_all(sequence.SequenceTracker(), [1, 2, 2, 4, 3, 3]),
+                         [0, 0, sequence.duplicate, 1, sequence.late, sequence.duplicate])
+
+    def test_wraparound(self):
+        self.assertEqual(record_all(sequence.SequenceTracker(), [0xFFFFFFFE, 0xFFFFFFFF, 0, 1, 2]), [0, 0, 0, 0, 0])
+
+    def test_gap_across_wraparound(self):
+        self.assertEqual(record_all(sequence.SequenceTracker(), [0xFFFFFFFE, 2, 0xFFFFFFFF, 0, 1]),
+                         [0, 3, sequence.late, sequence.late, sequence.late])
+
+    def test_first_sequence_before_wraparound_is_restart(self):
+        # Jumping straight to the first sequence number looks the same as the sender starting again
+        self.assertEqual(record_all(sequence.SequenceTracker(), [0xFFFFFFFE, 1]), [0, sequence.restart])
+
+    def test_restart_at_first_sequence(self):
+        # A sender that starts again goes back to sequence number 1
+        tracker = sequence.SequenceTracker()
+        self.assertEqual(record_all(tracker, [1, 2, 3, 1, 2]), [0, 0, 0, sequence.restart, 0])
+
+    def test_first_sequence_after_wraparound_is_in_order(self):
+        tracker = sequence.SequenceTracker()
+        self.assertEqual(record_all(tracker, [0xFFFFFFFF, 0, 1, 2]), [0, 0, 0, 0])
+
+    def test_restart_outside_window(self):
+        tracker = sequence.SequenceTracker()
+        start = 10 * sequence.window_size
+        self.assertEqual(record_all(tracker, [start, start + 1, 5, 6]), [0, 0, sequence.restart, 0])
+
+    def test_late_inside_window(self):
+        tracker = sequence.SequenceTracker()
+        start = 10 * sequence.window_size
+        self.assertEqual(record_all(tracker, [start, start + sequence.window_size, start + 1]),
+                         [0, sequence.window_size - 1, sequence.late])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# Network Tester traffic profile tests
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import traffic
+
+class ParseSizesTest(unittest.TestCase):
+    def test_single_size(self):
+        self.assertEqual(traffic.parse_sizes('160'), [(160, 1.0)])
+
+    def test_weights(self):
+        self.assertEqual(traffic.parse_sizes('64:7, 576:4,1472:1'), [(64, 7.0), (576, 4.0), (1472, 1.0)])
+
+    def test_imix(self):
+        self.assertEqual(traffic.parse_sizes(' imix '), traffic.imix_sizes)
+
+    def test_imix_raised_to_header_size(self):
+        self.assertEqual(traffic.parse_sizes('imix', 20), [(20, 7), (548, 4), (1472, 1)])
+
+    def test_other_sizes_not_raised(self):
+        self.assertEqual(traffic.parse_sizes('12', 20), [(12, 1.0)])
+
+    def test_invalid(self):
+        for text in ['', 'abc', '64:x', '64:0', '64:-1']:
+            with self.assertRaises(ValueError, msg=text):
+                traffic.parse_sizes(text)
+
+if __name__ == '__main__':
+    unittest.main()
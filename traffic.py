@@ -0,0 +1,169 @@
+# Network Tester traffic profiles
+#
+# Copyright (c) 2016-2018 4RF
+#
+# This file is subject to the terms and conditions of the GNU General Public
+# License Version 3.  See the file "LICENSE" in the main directory of this
+# archive for more details.
+#
+# A traffic profile is a file with a section for each flow, sent together from one process with --traffic:
+#
+#   [voice]
+#   address = 10.0.0.2        destination, default --address
+#   port = 20000              destination port, default --port
+#   sizes = 160               payload sizes, as size:weight pairs separated by commas, eg 64:7,576:4,1472:1,
+#                             or imix for the simple IMIX of 40, 576 and 1500 byte IP packets in the ratio 7:4:1
+#                             (the smallest are made larger if the header needs more room, as it does with --latency)
+#   rate = 64000              ethernet bitrate, while on for an onoff flow
+#   arrival = constant        constant, poisson (exponential gaps with the same mean), or onoff
+#   on = 0.5                  seconds sending, then seconds silent, for an onoff flow
+#   off = 1.5
+#   start = 0                 seconds after starting before the flow's first packet
+#   count = 1                 number of identical flows, named voice.1, voice.2, ... if more than one
+#
+# Each flow sends from its own socket, with its own sequence numbers, so the listener reports on each separately.
+#
+# The flows are kept in a heap ordered by when each is next due to send, so choosing the next packet costs
+# O(log n) however many flows there are. A flow's departures are scheduled from when its last packet was due,
+# rather than when it was sent, so each flow keeps to its rate on average. A flow that falls more than
+# max_schedule_lag behind catches up no further than that, rather than sending a long burst.
+
+import bisect
+import configparser
+import heapq
+import random
+
+arrival_names = ['constant', 'poisson', 'onoff']
+
+# Payload sizes of the IMIX packets, less the IP and UDP headers
+imix_sizes = [(12, 7), (548, 4), (1472, 1)]
+
+max_schedule_lag = 0.1
+
+class TrafficFlow:
+    def __init__(self, name, address, port, sizes, rate, arrival, on_time, off_time, start_time, overhead):
+        self.name = name
+        self.address = (address, port)
+        self.sizes = [size for size, weight in sizes]
+        self.cum_weights = []
+        total = 0
+        for size, weight in sizes:
+            total += weight
+            self.cum_weights.append(total)
+        # Bits of each size at the ethernet layer
+        self.bits = dict((size, (size + overhead(size)) * 8) for size in self.sizes)
+        self.rate = rate
+        self.arrival = arrival
+        self.on_time = on_time
+        self.off_time = off_time
+        self.start_time = start_time
+        self.on_end = None
+        self.sock = None
+        self.sequence_number = 0
+        self.measure_packets = 0
+        self.measure_bytes = 0
+        self.measure_bits = 0
+        self.would_block = 0
+
+    # Choose the size of the next packet, with the chance of each size in proportion to its weight
+    def next_size(self):
+        if len(self.sizes) == 1:
+            return self.sizes[0]
+        return self.sizes[bisect.bisect_right(self.cum_weights, random.random() * self.cum_weights[-1])]
+
+    # The first departure, with the flow starting at start
+    def first_departure(self, start):
+        first = start + self.start_time
+        if self.arrival == 'onoff':
+            self.on_end = first + self.on_time
+        return first
+
+    # When the next packet is due, after one of size bytes that was due at due. now is the current time.
+    def next_departure(self, due, size, now):
+        due = max(due, now - max_schedule_lag)
+        gap = self.bits[size] / self.rate
+        if self.arrival == 'poisson':
+            return due + random.expovariate(1.0 / gap)
+        due += gap
+        if (self.arrival == 'onoff') and (due >= self.on_end):
+            due = max(self.on_end, now - max_schedule_lag) + self.off_time
+            self.on_end = due + self.on_time
+        return due
+
+class Scheduler:
+    # The flows in order of when each is next due to send
+    def __init__(self, flows, start):
+        self.heap = [(flow.first_departure(start), x) for x, flow in enumerate(flows)]
+        heapq.heapify(self.heap)
+
+    # Returns (time, flow number) of the next departure
+    def next(self):
+        return self.heap[0]
+
+    # Replace the next departure, which has just been sent, with the flow's following one
+    def reschedule(self, due, number):
+        heapq.heapreplace(self.heap, (due, number))
+
+# Read the payload sizes of a flow. Returns a list of (size, weight). IMIX payloads smaller than min_size, which
+# is the room the packet header needs, are raised to it.
+def parse_sizes(text, min_size=0):
+    if text.strip() == 'imix':
+        return [(max(size, min_size), weight) for size, weight in imix_sizes]
+    sizes = []
+    for item in text.split(','):
+        fields = item.split(':')
+        size = int(fields[0])
+        weight = 1.0
+        if len(fields) > 1:
+            weight = float(fields[1])
+        if weight <= 0:
+            raise ValueError('size weights must be more than 0')
+        sizes.append((size, weight))
+    return sizes
+
+# Read the flows from a profile file. overhead(size) gives the ethernet overhead of a packet of size bytes, and
+# sizes must be from min_size to max_size. Raises ValueError if the profile isn't valid.
+def load_flows(path, default_address, default_port, overhead, min_size, max_size):
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(path):
+            raise ValueError('can not read {}'.format(path))
+    except configparser.Error as e:
+        raise ValueError(str(e).strip())
+
+    flows = []
+    for name in config.sections():
+        section = config[name]
+        try:
+            sizes = parse_sizes(section.get('sizes', 'imix'), min_size)
+            rate = section.getfloat('rate', 500000)
+            arrival = section.get('arrival', 'constant')
+            on_time = section.getfloat('on', 1.0)
+            off_time = section.getfloat('off', 1.0)
+            start_time = section.getfloat('start', 0)
+            count = section.getint('count', 1)
+            port = section.getint('port', default_port)
+        except ValueError as e:
+            raise ValueError('flow {}: {}'.format(name, e))
+        address = section.get('address', default_address)
+        if [size for size, weight in sizes if (size < min_size) or (size > max_size)]:
+            raise ValueError('flow {}: sizes must be from {} to {} bytes'.format(name, min_size, max_size))
+        if rate <= 0:
+            raise ValueError('flow {}: rate must be more than 0'.format(name))
+        if arrival not in arrival_names:
+            raise ValueError('flow {}: arrival must be one of {}'.format(name, ', '.join(arrival_names)))
+        if (arrival == 'onoff') and ((on_time <= 0) or (off_time < 0)):
+            raise ValueError('flow {}: on must be more than 0, and off 0 or more'.format(name))
+        if (start_time < 0) or (count < 1):
+            raise ValueError('flow {}: start must be 0 or more, and count 1 or more'.format(name))
+        if address == '0.0.0.0':
+            raise ValueError('flow {}: no address'.format(name))
+
+        for x in range(count):
+            flow_name = name
+            if count > 1:
+                flow_name = '{}.{}'.format(name, x + 1)
+            flows.append(TrafficFlow(flow_name, address, port, sizes, rate, arrival, on_time, off_time, start_time, overhead))
+    if not flows:
+        raise ValueError('no flows in {}'.format(path))
+    return flows